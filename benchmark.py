@@ -0,0 +1,460 @@
+"""Load-test harness for pr_testbot.
+
+Starts the bot in-process against local stand-ins for the GitHub API, the SMTP
+relay and deploy.sh/cleanup.sh, drives signed pull_request webhooks at it at a
+fixed rate, and reports acknowledgement latency, end-to-end deploy latency and
+throughput.
+
+With --startup it instead measures how long a fresh interpreter takes to import
+main.py and to run the optional warm-up. With --gevent the bot runs in its gevent
+serving mode instead of the default threaded one.
+
+Example:
+    python benchmark.py --events 200 --rate 20 --deploy-latency 0.5 --github-latency 0.05
+    python benchmark.py --events 200 --rate 50 --workers 200 --gevent
+    python benchmark.py --startup 10
+"""
+import sys
+
+# gevent has to patch the standard library before anything else imports it, so this
+# option is checked here instead of waiting for argparse
+if '--gevent' in sys.argv[1:]:
+    from gevent import monkey
+    monkey.patch_all()
+
+import argparse
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import socketserver
+import stat
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+WEBHOOK_SECRET = 'benchmark-secret'
+
+FAKE_DEPLOY_SCRIPT = '''#!/bin/bash
+echo "Updating the repository mirror..."
+sleep "$FAKE_CLONE_LATENCY"
+echo "No docker-compose file found, using Docker for deployment..."
+sleep "$FAKE_BUILD_LATENCY"
+echo "Running Docker container container_$1_$2_$DEPLOY_PORT on port $DEPLOY_PORT..."
+sleep "$FAKE_RUN_LATENCY"
+echo "Container name: container_$1_$2_$DEPLOY_PORT"
+echo "Image name: pr_testbot/benchmark:${4:-latest}"
+echo "Deployment complete: http://$DEPLOY_HOST:$DEPLOY_PORT"
+'''
+
+FAKE_CLEANUP_SCRIPT = '''#!/bin/bash
+shift 2
+for CONTAINER_NAME in "$@"; do
+  echo "Container $CONTAINER_NAME cleaned up successfully."
+done
+'''
+
+ISSUE_COMMENTS_PATH = re.compile(r'^/repos/([^/]+/[^/]+)/issues/(\d+)/comments')
+COMMENT_PATH = re.compile(r'^/repos/([^/]+/[^/]+)/issues/comments/(\d+)$')
+ACCESS_TOKEN_PATH = re.compile(r'^/app/installations/(\d+)/access_tokens$')
+
+class FakeGitHubServer(ThreadingHTTPServer):
+    """Minimal GitHub API stand-in that records when and how each PR's deployment finished."""
+
+    daemon_threads = True
+
+    def __init__(self, address, latency):
+        super().__init__(address, FakeGitHubHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.comments = {}
+        self.next_comment_id = 1
+        self.completed_at = {}
+        self.failed = set()
+        self.requests = 0
+
+    @property
+    def base_url(self):
+        return f'http://{self.server_address[0]}:{self.server_address[1]}'
+
+    def record_body(self, repo_name, pr_number, body):
+        key = (repo_name, pr_number)
+        if key in self.completed_at:
+            return
+        if 'Deployment successful' in body or 'Deployment failed' in body:
+            self.completed_at[key] = time.time()
+            if 'Deployment failed' in body:
+                self.failed.add(key)
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_json(self):
+        length = int(self.headers.get('Content-Length', 0))
+        return json.loads(self.rfile.read(length)) if length else {}
+
+    def handle_request(self, method):
+        server = self.server
+        payload = self.read_json() if method in ('POST', 'PATCH') else None
+        time.sleep(server.latency)
+        path = self.path.split('?', 1)[0]
+        with server.lock:
+            server.requests += 1
+
+            match = ACCESS_TOKEN_PATH.match(path)
+            if match and method == 'POST':
+                expires_at = datetime.now(timezone.utc) + timedelta(hours=1)
+                return self.send_json(201, {'token': f'fake-token-{match.group(1)}', 'expires_at': expires_at.strftime('%Y-%m-%dT%H:%M:%SZ')})
+
+            match = ISSUE_COMMENTS_PATH.match(path)
+            if match:
+                repo_name, pr_number = match.group(1), int(match.group(2))
+                if method == 'GET':
+                    comments = [comment for comment in server.comments.values() if comment['issue'] == (repo_name, pr_number)]
+                    return self.send_json(200, [{'url': c['url'], 'body': c['body'], 'user': {'type': 'Bot'}} for c in comments])
+                if method == 'POST':
+                    comment_id = server.next_comment_id
+                    server.next_comment_id += 1
+                    comment = {
+                        'issue': (repo_name, pr_number),
+                        'url': f'{server.base_url}/repos/{repo_name}/issues/comments/{comment_id}',
+                        'body': payload['body']
+                    }
+                    server.comments[comment_id] = comment
+                    server.record_body(repo_name, pr_number, comment['body'])
+                    return self.send_json(201, {'id': comment_id, 'url': comment['url'], 'body': comment['body']})
+
+            match = COMMENT_PATH.match(path)
+            if match and method == 'PATCH':
+                comment = server.comments.get(int(match.group(2)))
+                if comment is None:
+                    return self.send_json(404, {'message': 'Not Found'})
+                comment['body'] = payload['body']
+                server.record_body(*comment['issue'], comment['body'])
+                return self.send_json(200, {'id': int(match.group(2)), 'url': comment['url'], 'body': comment['body']})
+
+        self.send_json(404, {'message': 'Not Found'})
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def do_PATCH(self):
+        self.handle_request('PATCH')
+
+class FakeSMTPServer(socketserver.ThreadingTCPServer):
+    """SMTP relay stand-in that accepts AUTH PLAIN and counts delivered messages."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, latency):
+        super().__init__(address, FakeSMTPHandler)
+        self.latency = latency
+        self.messages = 0
+        self.connections = 0
+        self.lock = threading.Lock()
+
+class FakeSMTPHandler(socketserver.StreamRequestHandler):
+
+    def reply(self, line):
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.reply('220 fake-smtp ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            command = line.decode(errors='replace').strip().upper()
+            if command.startswith(('EHLO', 'HELO')):
+                self.reply('250-fake-smtp')
+                self.reply('250 AUTH PLAIN LOGIN')
+            elif command.startswith('AUTH'):
+                self.reply('235 Authentication successful')
+            elif command == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                time.sleep(self.server.latency)
+                with self.server.lock:
+                    self.server.messages += 1
+                self.reply('250 OK')
+            elif command == 'QUIT':
+                self.reply('221 Bye')
+                break
+            else:
+                self.reply('250 OK')
+
+def percentile(values, fraction):
+    """Return the value at the given fraction of a list of samples."""
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+def write_script(directory, name, content):
+    path = os.path.join(directory, name)
+    with open(path, 'w') as script:
+        script.write(content)
+    os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+    return path
+
+def write_private_key(directory):
+    """Generate a throwaway RSA key for signing App JWTs."""
+    from cryptography.hazmat.primitives import serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    path = os.path.join(directory, 'benchmark-key.pem')
+    with open(path, 'wb') as key_file:
+        key_file.write(key.private_bytes(
+            encoding=serialization.Encoding.PEM,
+            format=serialization.PrivateFormat.TraditionalOpenSSL,
+            encryption_algorithm=serialization.NoEncryption()
+        ))
+    return path
+
+def build_payload(index, repos):
+    """Build a pull_request webhook payload for the index-th event."""
+    repo_name = f'benchmark/repo-{index % repos}'
+    return {
+        'action': 'opened',
+        'pull_request': {
+            'number': index + 1,
+            'head': {
+                'ref': f'benchmark-{index}',
+                'sha': uuid.uuid4().hex + uuid.uuid4().hex[:8],
+                'repo': {'clone_url': f'https://github.com/{repo_name}.git'}
+            }
+        },
+        'repository': {'full_name': repo_name},
+        'installation': {'id': 1}
+    }
+
+def send_webhook(url, payload):
+    """Send one signed webhook and return its acknowledgement latency and status code."""
+    body = json.dumps(payload).encode()
+    signature = 'sha256=' + hmac.new(WEBHOOK_SECRET.encode(), msg=body, digestmod=hashlib.sha256).hexdigest()
+    headers = {
+        'Content-Type': 'application/json',
+        'X-GitHub-Event': 'pull_request',
+        'X-GitHub-Delivery': str(uuid.uuid4()),
+        'X-Hub-Signature-256': signature
+    }
+    started_at = time.time()
+    response = requests.post(url, data=body, headers=headers, timeout=30)
+    return started_at, time.time() - started_at, response.status_code
+
+def measure_startup(runs, workdir, gevent=False):
+    """Time importing main.py, and importing plus warm-up, in fresh interpreters."""
+    env = dict(os.environ, PRIVATE_KEY_PATH=write_private_key(workdir), WEBHOOK_SECRET=WEBHOOK_SECRET, APP_ID='1',
+               SERVER_MODE='gevent' if gevent else 'threaded')
+    script = (
+        'import time; started_at = time.perf_counter(); import main; imported_at = time.perf_counter(); '
+        'main.warm_up(); print(imported_at - started_at, time.perf_counter() - started_at)'
+    )
+    import_times = []
+    warm_times = []
+    for _ in range(runs):
+        result = subprocess.run([sys.executable, '-c', script], cwd=os.path.dirname(os.path.abspath(__file__)), env=env,
+                                capture_output=True, text=True, check=True)
+        import_time, warm_time = result.stdout.split()[-2:]
+        import_times.append(float(import_time))
+        warm_times.append(float(warm_time))
+    return {
+        'runs': runs,
+        'import_p50': percentile(import_times, 0.50),
+        'import_max': max(import_times),
+        'import_and_warm_up_p50': percentile(warm_times, 0.50),
+        'import_and_warm_up_max': max(warm_times)
+    }
+
+def configure_environment(args, workdir, github_url, smtp_port):
+    """Point the bot at the stand-ins before main.py is imported."""
+    # Values are set explicitly rather than removed, because main.py's load_dotenv() fills
+    # in any key missing from the environment from the .env file of a real deployment
+    os.environ.update({
+        'WEBHOOK_SECRET': WEBHOOK_SECRET,
+        'APP_ID': '1',
+        'PRIVATE_KEY_PATH': write_private_key(workdir),
+        'SMTP_SERVER': '127.0.0.1',
+        'SMTP_PORT': str(smtp_port),
+        'SMTP_USERNAME': 'benchmark@example.com',
+        'SMTP_PASSWORD': 'benchmark',
+        'SMTP_STARTTLS': 'false',
+        'RECIPIENT_EMAIL': 'recipient@example.com',
+        'GITHUB_API_URL': github_url,
+        'DEPLOY_SCRIPT': write_script(workdir, 'fake_deploy.sh', FAKE_DEPLOY_SCRIPT),
+        'CLEANUP_SCRIPT': write_script(workdir, 'fake_cleanup.sh', FAKE_CLEANUP_SCRIPT),
+        'JOB_DIR': os.path.join(workdir, 'jobs'),
+        'PORT_STATE_FILE': os.path.join(workdir, 'ports.json'),
+        'STATE_DB_PATH': os.path.join(workdir, 'state.db'),
+        'WORKSPACE_ROOT': workdir,
+        'LOG_DIR': os.path.join(workdir, 'logs'),
+        'MIRROR_DIR': os.path.join(workdir, 'mirrors'),
+        'BASE_IMAGE_PREPULL': 'false',
+        'PUBLIC_HOST': '127.0.0.1',
+        'DEPLOY_WORKERS': str(args.workers),
+        'BUILD_CONCURRENCY': str(args.build_concurrency or args.workers),
+        'DEPLOY_DEBOUNCE': str(args.debounce),
+        'FAKE_CLONE_LATENCY': str(args.deploy_latency / 3),
+        'FAKE_BUILD_LATENCY': str(args.deploy_latency / 3),
+        'FAKE_RUN_LATENCY': str(args.deploy_latency / 3),
+        'DOCKER_HOSTS': '',
+        'SERVER_MODE': 'gevent' if args.gevent else 'threaded',
+        'DEPLOY_ACTIONS': 'opened,synchronize,reopened',
+        'EMAIL_DIGEST_INTERVAL': '0',
+        'INCREMENTAL_COMPOSE_DEPLOY': 'false',
+        'LOG_URL_BASE': ''
+    })
+    if args.status_interval is not None:
+        os.environ['STATUS_UPDATE_INTERVAL'] = str(args.status_interval)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pr_testbot against local GitHub, SMTP and Docker stand-ins.')
+    parser.add_argument('--events', type=int, default=100, help='number of webhooks to send')
+    parser.add_argument('--rate', type=float, default=10, help='webhooks sent per second')
+    parser.add_argument('--repos', type=int, default=5, help='number of repositories the events are spread over')
+    parser.add_argument('--workers', type=int, default=4, help='DEPLOY_WORKERS for the bot')
+    parser.add_argument('--build-concurrency', type=int, default=None, help='BUILD_CONCURRENCY for the bot (default: --workers)')
+    parser.add_argument('--debounce', type=float, default=0, help='DEPLOY_DEBOUNCE for the bot')
+    parser.add_argument('--status-interval', type=float, default=None, help='STATUS_UPDATE_INTERVAL for the bot')
+    parser.add_argument('--deploy-latency', type=float, default=0.5, help='seconds the fake deploy.sh takes')
+    parser.add_argument('--github-latency', type=float, default=0.05, help='seconds added to every fake GitHub API call')
+    parser.add_argument('--smtp-latency', type=float, default=0.05, help='seconds added to every fake SMTP message')
+    parser.add_argument('--timeout', type=float, default=300, help='seconds to wait for deployments to finish')
+    parser.add_argument('--startup', type=int, metavar='RUNS', help='measure import and warm-up time over RUNS fresh interpreters instead')
+    parser.add_argument('--gevent', action='store_true', help='run the bot in the gevent serving mode (SERVER_MODE=gevent)')
+    parser.add_argument('--json', dest='json_path', help='also write the results to this file as JSON')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    workdir = tempfile.mkdtemp(prefix='pr_testbot_benchmark_')
+
+    if args.startup:
+        results = measure_startup(args.startup, workdir, args.gevent)
+        print(f"Import main.py (s):    p50={results['import_p50']:.4f} max={results['import_max']:.4f}")
+        print(f"Import + warm-up (s):  p50={results['import_and_warm_up_p50']:.4f} max={results['import_and_warm_up_max']:.4f}")
+        if args.json_path:
+            with open(args.json_path, 'w') as json_file:
+                json.dump(results, json_file, indent=2)
+        return 0
+    github = FakeGitHubServer(('127.0.0.1', 0), args.github_latency)
+    smtp = FakeSMTPServer(('127.0.0.1', 0), args.smtp_latency)
+    threading.Thread(target=github.serve_forever, daemon=True).start()
+    threading.Thread(target=smtp.serve_forever, daemon=True).start()
+    configure_environment(args, workdir, github.base_url, smtp.server_address[1])
+
+    # Imported here so the bot reads the stand-in configuration
+    import main as bot
+
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    bot.start_workers()
+    if args.gevent:
+        from gevent.pywsgi import WSGIServer
+        app_server = WSGIServer(('127.0.0.1', 0), bot.app, log=None)
+        app_server.start()
+    else:
+        from werkzeug.serving import make_server
+        app_server = make_server('127.0.0.1', 0, bot.app, threaded=True)
+        threading.Thread(target=app_server.serve_forever, daemon=True).start()
+    webhook_url = f'http://127.0.0.1:{app_server.server_port}/webhook'
+
+    sent_at = {}
+    ack_latencies = []
+    status_codes = {}
+    started_at = time.time()
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        futures = {}
+        for index in range(args.events):
+            # Pace the events at the requested rate
+            delay = started_at + index / args.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            payload = build_payload(index, args.repos)
+            key = (payload['repository']['full_name'], payload['pull_request']['number'])
+            futures[key] = executor.submit(send_webhook, webhook_url, payload)
+        for key, future in futures.items():
+            request_started_at, latency, status_code = future.result()
+            sent_at[key] = request_started_at
+            ack_latencies.append(latency)
+            status_codes[status_code] = status_codes.get(status_code, 0) + 1
+    sending_finished_at = time.time()
+
+    # Wait for every accepted event to report its deployment result on the PR
+    deadline = time.time() + args.timeout
+    while time.time() < deadline:
+        with github.lock:
+            if len(github.completed_at) >= len(sent_at):
+                break
+        time.sleep(0.1)
+    finished_at = time.time()
+
+    with github.lock:
+        # Failed deployments can finish early, so only successful ones count towards latency and throughput
+        end_to_end = [github.completed_at[key] - sent_at[key] for key in sent_at
+                      if key in github.completed_at and key not in github.failed]
+        failed = len([key for key in sent_at if key in github.failed])
+        github_requests = github.requests
+    results = {
+        'events': args.events,
+        'status_codes': status_codes,
+        'succeeded': len(end_to_end),
+        'failed': failed,
+        'unfinished': len(sent_at) - len(end_to_end) - failed,
+        'ack_latency_p50': percentile(ack_latencies, 0.50),
+        'ack_latency_p90': percentile(ack_latencies, 0.90),
+        'ack_latency_p99': percentile(ack_latencies, 0.99),
+        'end_to_end_p50': percentile(end_to_end, 0.50),
+        'end_to_end_p90': percentile(end_to_end, 0.90),
+        'end_to_end_p99': percentile(end_to_end, 0.99),
+        'accepted_per_second': args.events / (sending_finished_at - started_at),
+        'completed_per_second': len(end_to_end) / (finished_at - started_at),
+        'github_requests': github_requests,
+        'smtp_connections': smtp.connections,
+        'emails': smtp.messages
+    }
+
+    print(f"Events sent:           {results['events']} (status codes: {results['status_codes']})")
+    print(f"Deployments:           succeeded={results['succeeded']} failed={results['failed']} unfinished={results['unfinished']}")
+    print(f"Ack latency (s):       p50={results['ack_latency_p50']:.4f} p90={results['ack_latency_p90']:.4f} p99={results['ack_latency_p99']:.4f}")
+    print(f"End-to-end (s):        p50={results['end_to_end_p50']:.3f} p90={results['end_to_end_p90']:.3f} p99={results['end_to_end_p99']:.3f}")
+    print(f"Throughput (events/s): accepted={results['accepted_per_second']:.2f} completed={results['completed_per_second']:.2f}")
+    print(f"GitHub API requests:   {results['github_requests']}")
+    print(f"SMTP connections:      {results['smtp_connections']} for {results['emails']} email(s)")
+
+    if args.json_path:
+        with open(args.json_path, 'w') as json_file:
+            json.dump(results, json_file, indent=2, default=str)
+
+    return 0 if results['succeeded'] == len(sent_at) else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
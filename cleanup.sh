@@ -23,32 +23,41 @@ fi
 # Variables
 BRANCH_NAME=$1
 PR_NUMBER=$2
-REMOTE_DIR="/tmp/pr_testbot-$BRANCH_NAME"
+REMOTE_DIR="${DEPLOY_WORKSPACE:-/tmp/pr_testbot-$BRANCH_NAME}"
+# Remaining arguments are the containers recorded for this PR by the bot
+shift 2
 
-# Stop and remove Docker Compose services if docker-compose file exists
-if [ -f "$REMOTE_DIR/docker-compose.yml" ] || [ -f "$REMOTE_DIR/docker-compose.yaml" ]; then
-  echo "Found docker-compose file, stopping Docker Compose services..."
-  docker-compose -f "$REMOTE_DIR/docker-compose.yml" down || docker-compose -f "$REMOTE_DIR/docker-compose.yaml" down
-else
-  # Find and read all container info files for the given branch and PR
+# Deployments made before the bot kept a state database recorded their containers in
+# /tmp/container_info_* files and used a per-branch checkout on the local engine
+if [ -z "$DOCKER_HOST" ]; then
   for CONTAINER_INFO_FILE in /tmp/container_info_${BRANCH_NAME}_${PR_NUMBER}_*.txt; do
     if [ -f "$CONTAINER_INFO_FILE" ]; then
-      # Read the container name and port from the file
       while read -r CONTAINER_NAME PORT; do
         if [ -n "$CONTAINER_NAME" ]; then
-          # Stop and remove the container
-          docker stop "$CONTAINER_NAME"
-          docker rm "$CONTAINER_NAME"
-          echo "Container $CONTAINER_NAME cleaned up successfully."
-
-          # Remove the container info file
-          rm "$CONTAINER_INFO_FILE"
-        else
-          echo "No container found for branch $BRANCH_NAME with PR $PR_NUMBER."
+          set -- "$@" "$CONTAINER_NAME"
         fi
       done < "$CONTAINER_INFO_FILE"
-    else
-      echo "No container information file found for branch $BRANCH_NAME with PR $PR_NUMBER."
+      rm -f "$CONTAINER_INFO_FILE"
     fi
   done
+  LEGACY_DIR="/tmp/pr_testbot-$BRANCH_NAME"
+  if [ ! -f "$REMOTE_DIR/docker-compose.yml" ] && [ ! -f "$REMOTE_DIR/docker-compose.yaml" ] && [ -d "$LEGACY_DIR" ]; then
+    REMOTE_DIR="$LEGACY_DIR"
+  fi
+fi
+
+# Stop and remove Docker Compose services if docker-compose file exists
+if [ -f "$REMOTE_DIR/docker-compose.yml" ] || [ -f "$REMOTE_DIR/docker-compose.yaml" ]; then
+  echo "Found docker-compose file, stopping Docker Compose services..."
+  docker-compose -f "$REMOTE_DIR/docker-compose.yml" down || docker-compose -f "$REMOTE_DIR/docker-compose.yaml" down
+else
+  if [ $# -eq 0 ]; then
+    echo "No container found for branch $BRANCH_NAME with PR $PR_NUMBER."
+  fi
+  for CONTAINER_NAME in "$@"; do
+    # Stop and remove the container
+    docker stop "$CONTAINER_NAME"
+    docker rm "$CONTAINER_NAME"
+    echo "Container $CONTAINER_NAME cleaned up successfully."
+  done
 fi
@@ -8,6 +8,17 @@ if [[ "$(id -u)" -ne 0 ]]; then
   exit
 fi
 
+# The bot cancels a superseded build by signalling the sudo wrapper, and sudo only forwards
+# the signal to this shell. Run the deployment in its own process group and pass the signal
+# on to the whole group, so root-owned children like docker build and git fetch stop too.
+if [ -z "$PR_TESTBOT_DEPLOY_GROUP" ]; then
+  PR_TESTBOT_DEPLOY_GROUP=1 setsid bash "$0" "$@" &
+  DEPLOY_PID=$!
+  trap 'kill -TERM -- -"$DEPLOY_PID" 2>/dev/null' TERM INT
+  wait "$DEPLOY_PID"
+  exit $?
+fi
+
 # Check if the branch name is provided
 if [ -z "$1" ]; then
   echo "Branch name not provided."
@@ -30,25 +41,52 @@ fi
 BRANCH_NAME=$1
 PR_NUMBER=$2
 REPO_URL=$3
-REMOTE_HOST=$(curl -s https://api.ipify.org)
-REMOTE_DIR="/tmp/pr_testbot-$BRANCH_NAME"
-TIMESTAMP=$(date +%s)
-CONTAINER_INFO_FILE="/tmp/container_info_${BRANCH_NAME}_${PR_NUMBER}_${TIMESTAMP}.txt"
+HEAD_SHA=$4
+REMOTE_HOST=${DEPLOY_HOST:-$(curl -s https://api.ipify.org)}
+REMOTE_DIR="${DEPLOY_WORKSPACE:-/tmp/pr_testbot-$BRANCH_NAME}"
 COMPOSE_FILE_YML="docker-compose.yml"
 COMPOSE_FILE_YAML="docker-compose.yaml"
+MIRROR_ROOT="${MIRROR_DIR:-/var/cache/pr_testbot/mirrors}"
+MIRROR_PATH="$MIRROR_ROOT/$(echo "$REPO_URL" | sed -e 's#^[a-z]*://##' -e 's#[/:@]#_#g')"
+
+mkdir -p "$MIRROR_ROOT"
+
+# Serialize mirror updates between concurrent deployments of the same repository
+exec 9>"$MIRROR_PATH.lock"
+flock 9
 
-# Remove existing directory if it exists to avoid conflicts
-if [ -d "$REMOTE_DIR" ]; then
+if [ -d "$MIRROR_PATH" ]; then
+  echo "Updating the repository mirror..."
+  # Fetch only the branch being deployed into the existing bare mirror
+  if ! git --git-dir="$MIRROR_PATH" fetch --prune origin "+refs/heads/$BRANCH_NAME:refs/heads/$BRANCH_NAME"; then
+    echo "Failed to fetch branch $BRANCH_NAME into the repository mirror"
+    exit 1
+  fi
+else
+  echo "Cloning the repository mirror..."
+  if ! git clone --mirror "$REPO_URL" "$MIRROR_PATH"; then
+    echo "Failed to clone the repository or checkout branch $BRANCH_NAME"
+    exit 1
+  fi
+fi
+
+# Remove the existing worktree if it exists to avoid conflicts
+if [ -e "$REMOTE_DIR" ]; then
+  git --git-dir="$MIRROR_PATH" worktree remove --force "$REMOTE_DIR" 2>/dev/null
   rm -rf "$REMOTE_DIR"
 fi
+git --git-dir="$MIRROR_PATH" worktree prune
 
-echo "Cloning the repository..."
-# Clone the repository and checkout the branch
-if ! git clone --branch "$BRANCH_NAME" "$REPO_URL" "$REMOTE_DIR"; then
+echo "Checking out branch $BRANCH_NAME into $REMOTE_DIR..."
+# Create a worktree for the pull request's head commit (or the branch tip) from the local mirror
+if ! git --git-dir="$MIRROR_PATH" worktree add --force --detach "$REMOTE_DIR" "${HEAD_SHA:-refs/heads/$BRANCH_NAME}"; then
   echo "Failed to clone the repository or checkout branch $BRANCH_NAME"
   exit 1
 fi
 
+flock -u 9
+exec 9>&-
+
 echo "Changing directory to $REMOTE_DIR..."
 # Navigate to the project directory
 if ! cd "$REMOTE_DIR"; then
@@ -58,8 +96,19 @@ fi
 
 if [ -f "$COMPOSE_FILE_YML" ] || [ -f "$COMPOSE_FILE_YAML" ]; then
   echo "Found docker-compose file, using Docker Compose for deployment..."
-  # Deploy using Docker Compose
-  if ! docker-compose up -d; then
+  # Deploy using Docker Compose. When the bot passes DEPLOY_SERVICES, only those services
+  # are rebuilt and restarted and the rest of the running stack is left alone.
+  if [ -z "${DEPLOY_SERVICES+x}" ]; then
+    COMPOSE_ARGS=(up -d --build)
+  elif [ -z "$DEPLOY_SERVICES" ]; then
+    echo "No services affected by the changes, keeping the running services..."
+    COMPOSE_ARGS=(up -d)
+  else
+    echo "Redeploying changed services: $DEPLOY_SERVICES"
+    read -r -a CHANGED_SERVICES <<< "$DEPLOY_SERVICES"
+    COMPOSE_ARGS=(up -d --build --force-recreate --no-deps "${CHANGED_SERVICES[@]}")
+  fi
+  if ! docker-compose "${COMPOSE_ARGS[@]}"; then
     echo "Docker Compose up failed"
     exit 1
   fi
@@ -87,29 +136,34 @@ else
       echo $PORT
   }
 
-  # Get an available random port
-  PORT=$(find_random_port)
+  # Use the port reserved by the bot, or find an available random port
+  PORT=${DEPLOY_PORT:-$(find_random_port)}
 
   # Unique container name based on branch, port, and PR number
-  CONTAINER_NAME="container_${BRANCH_NAME}_${PR_NUMBER}_${PORT}"
+  # Docker only accepts [a-zA-Z0-9_.-] in container names, so branches like feature/x are flattened
+  CONTAINER_NAME="container_$(echo "$BRANCH_NAME" | sed 's#[^a-zA-Z0-9_.-]#_#g')_${PR_NUMBER}_${PORT}"
+
+  # Image tagged by repository and head commit so unchanged commits are not rebuilt
+  IMAGE_REPO="pr_testbot/$(echo "$REPO_URL" | sed -e 's#^[a-z]*://[^/]*/##' -e 's#\.git$##' | tr '[:upper:]' '[:lower:]' | sed 's#[^a-z0-9._-]#_#g')"
+  IMAGE_NAME="$IMAGE_REPO:$(git rev-parse HEAD)"
 
-  # Build the Docker image with a unique tag
-  if ! docker build -t $CONTAINER_NAME .; then
+  # Build the Docker image unless one already exists for this commit
+  if docker image inspect "$IMAGE_NAME" >/dev/null 2>&1; then
+    echo "Image $IMAGE_NAME already exists, skipping build..."
+  elif ! docker build -t "$IMAGE_NAME" .; then
     echo "Docker build failed"
     exit 1
   fi
 
   echo "Running Docker container $CONTAINER_NAME on port $PORT..."
   # Run the Docker container with the random port and unique container name
-  if ! docker run -d -p $PORT:80 --name $CONTAINER_NAME $CONTAINER_NAME; then
+  if ! docker run -d -p $PORT:80 --name $CONTAINER_NAME "$IMAGE_NAME"; then
     echo "Docker run failed"
     exit 1
   fi
 
-  # Save container name and port information to a file for cleanup
-  echo "$CONTAINER_NAME $PORT" > $CONTAINER_INFO_FILE
-
-  # Output the container name and deployment link
+  # Output the container name, image and deployment link for the bot to record
   echo "Container name: $CONTAINER_NAME"
+  echo "Image name: $IMAGE_NAME"
   echo "Deployment complete: http://$REMOTE_HOST:$PORT"
 fi
@@ -1,24 +1,38 @@
-from flask import Flask, request, jsonify
+import os
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+# In the gevent serving mode the standard library is patched before anything else imports it,
+# so GitHub calls, SMTP, deploy.sh subprocesses and worker threads all become cooperative greenlets
+SERVER_MODE = os.getenv('SERVER_MODE', 'threaded')
+if SERVER_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, Response, request, jsonify
 import subprocess
-import requests
 import re
-import jwt
 import time
-import os
 import hmac
+import importlib
 import hashlib
 import logging
-from cryptography.hazmat.primitives import serialization
-from cryptography.hazmat.backends import default_backend
-from dotenv import load_dotenv
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
-
-# Load environment variables from .env file
-load_dotenv()
+import json
+import queue
+import threading
+import uuid
+import signal
+import socket
+import sqlite3
+import gzip
+import io
+import shutil
+from collections import deque
+from datetime import datetime, timezone
+from urllib.parse import urlparse
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
 
 app = Flask(__name__)
 
@@ -35,14 +49,215 @@ SMTP_PORT = os.getenv('SMTP_PORT')
 SMTP_USERNAME = os.getenv('SMTP_USERNAME')
 SMTP_PASSWORD = os.getenv('SMTP_PASSWORD')
 RECIPIENT_EMAIL = os.getenv('RECIPIENT_EMAIL')
+SMTP_STARTTLS = os.getenv('SMTP_STARTTLS', 'true').lower() != 'false'
+GITHUB_API_URL = os.getenv('GITHUB_API_URL', 'https://api.github.com').rstrip('/')
+DEPLOY_SCRIPT = os.getenv('DEPLOY_SCRIPT', './deploy.sh')
+CLEANUP_SCRIPT = os.getenv('CLEANUP_SCRIPT', './cleanup.sh')
+WARM_UP = os.getenv('WARM_UP', 'true').lower() != 'false'
+DEPLOY_WORKERS = int(os.getenv('DEPLOY_WORKERS', '4'))
+JOB_DIR = os.getenv('JOB_DIR', '/tmp/pr_testbot_jobs')
+TOKEN_REFRESH_MARGIN = int(os.getenv('TOKEN_REFRESH_MARGIN', '300'))
+TOKEN_REFRESH_INTERVAL = int(os.getenv('TOKEN_REFRESH_INTERVAL', '60'))
+TOKEN_IDLE_TTL = int(os.getenv('TOKEN_IDLE_TTL', '7200'))
+JWT_REFRESH_MARGIN = int(os.getenv('JWT_REFRESH_MARGIN', '60'))
+GITHUB_CONNECT_TIMEOUT = float(os.getenv('GITHUB_CONNECT_TIMEOUT', '5'))
+GITHUB_READ_TIMEOUT = float(os.getenv('GITHUB_READ_TIMEOUT', '30'))
+STATUS_UPDATE_INTERVAL = float(os.getenv('STATUS_UPDATE_INTERVAL', '3'))
+SMTP_IDLE_TIMEOUT = float(os.getenv('SMTP_IDLE_TIMEOUT', '60'))
+LOG_ATTACHMENT_MAX_BYTES = int(os.getenv('LOG_ATTACHMENT_MAX_BYTES', str(4 * 1024 * 1024)))
+EMAIL_ATTACHMENT_MAX_BYTES = int(os.getenv('EMAIL_ATTACHMENT_MAX_BYTES', str(1024 * 1024)))
+LOG_URL_BASE = os.getenv('LOG_URL_BASE', '').rstrip('/')
+LOG_DIR = os.getenv('LOG_DIR', '/tmp/pr_testbot_logs')
+LOG_RETENTION = int(os.getenv('LOG_RETENTION', str(14 * 24 * 3600)))
+EMAIL_DIGEST_INTERVAL = int(os.getenv('EMAIL_DIGEST_INTERVAL', '0'))
+EMAIL_DIGEST_FAILURES_IMMEDIATE = os.getenv('EMAIL_DIGEST_FAILURES_IMMEDIATE', 'true').lower() != 'false'
+DEPLOY_DEBOUNCE = float(os.getenv('DEPLOY_DEBOUNCE', '5'))
+DEPLOY_OUTPUT_TAIL_LINES = int(os.getenv('DEPLOY_OUTPUT_TAIL_LINES', '20'))
+PORT_RANGE_START = int(os.getenv('PORT_RANGE_START', '4000'))
+PORT_RANGE_END = int(os.getenv('PORT_RANGE_END', '7000'))
+PORT_STATE_FILE = os.getenv('PORT_STATE_FILE', '/tmp/pr_testbot_ports.json')
+PUBLIC_HOST = os.getenv('PUBLIC_HOST')
+PUBLIC_HOST_REFRESH_INTERVAL = int(os.getenv('PUBLIC_HOST_REFRESH_INTERVAL', '3600'))
+STATE_DB_PATH = os.getenv('STATE_DB_PATH', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'pr_testbot.db'))
+WORKSPACE_ROOT = os.getenv('WORKSPACE_ROOT', '/tmp')
+BUILD_CONCURRENCY = int(os.getenv('BUILD_CONCURRENCY', str(os.cpu_count() or 1)))
+DEPLOY_ACTIONS = [action.strip() for action in os.getenv('DEPLOY_ACTIONS', 'opened,synchronize,reopened').split(',') if action.strip()]
+DELIVERY_TTL = int(os.getenv('DELIVERY_TTL', '86400'))
+DELIVERY_CACHE_SIZE = int(os.getenv('DELIVERY_CACHE_SIZE', '100000'))
+# Docker engines to deploy to, as comma-separated DOCKER_HOST URLs optionally followed by =public-address
+DOCKER_HOSTS = [entry.strip() for entry in os.getenv('DOCKER_HOSTS', '').split(',') if entry.strip()]
+MIRROR_DIR = os.getenv('MIRROR_DIR', '/var/cache/pr_testbot/mirrors')
+BASE_IMAGE_PREPULL = os.getenv('BASE_IMAGE_PREPULL', 'true').lower() != 'false'
+BASE_IMAGE_PULL_INTERVAL = int(os.getenv('BASE_IMAGE_PULL_INTERVAL', '21600'))
+BASE_IMAGE_REFRESH_INTERVAL = int(os.getenv('BASE_IMAGE_REFRESH_INTERVAL', '3600'))
+BASE_IMAGE_PULL_WORKERS = int(os.getenv('BASE_IMAGE_PULL_WORKERS', '2'))
+INCREMENTAL_COMPOSE_DEPLOY = os.getenv('INCREMENTAL_COMPOSE_DEPLOY', 'true').lower() != 'false'
+
+# Compose files deploy.sh looks for, in order of preference
+COMPOSE_FILES = ['docker-compose.yml', 'docker-compose.yaml']
+
+# Files compose reads for every service, so a change to any of them redeploys the whole stack
+COMPOSE_SHARED_FILES = COMPOSE_FILES + ['docker-compose.override.yml', 'docker-compose.override.yaml', '.env']
+
+# Base images referenced by Dockerfiles
+FROM_PATTERN = re.compile(r'^\s*FROM\s+(?:--\S+\s+)*(\S+)(?:\s+AS\s+(\S+))?', re.IGNORECASE | re.MULTILINE)
+
+# Pull request actions the bot acts on; every other delivery is answered without further work
+HANDLED_ACTIONS = set(DEPLOY_ACTIONS) | {'closed'}
+
+# Matches the leading "action" key of a webhook payload so ignorable events can be skipped unparsed
+ACTION_PATTERN = re.compile(rb'^\s*\{\s*"action"\s*:\s*"([^"]*)"')
+
+# Accepted webhook jobs waiting for a deployment worker, queued per repository
+# and handed out round-robin so one busy repository cannot starve the others
+repo_queues = {}
+repo_order = deque()
+job_condition = threading.Condition()
+
+# IDs of the deployments holding one of the BUILD_CONCURRENCY build slots, guarded by job_condition
+build_slots = set()
+
+# Repositories whose base images should be pulled ahead of their builds, and when each
+# (Docker engine, image) pair was last pulled
+prepull_queue = queue.Queue()
+pulled_images = {}
+pulled_images_lock = threading.Lock()
+
+# Deployments currently being scheduled onto each Docker engine
+docker_host_inflight = {}
+docker_host_lock = threading.Lock()
 
-# Load the private key
-with open(PRIVATE_KEY_PATH, 'r') as key_file:
-    private_key = serialization.load_pem_private_key(
-        key_file.read().encode(),
-        password=None,
-        backend=default_backend()
-    )
+# Newest job ID, running deployment and serialisation lock per pull request
+latest_jobs = {}
+running_deployments = {}
+pr_locks = {}
+pr_state_lock = threading.Lock()
+
+# Deployment ports reserved by the bot: a bitmap over the port range plus the owning PR of each port
+port_bitmap = bytearray(PORT_RANGE_END - PORT_RANGE_START + 1)
+port_owners = {}
+port_cursor = 0
+port_lock = threading.Lock()
+
+# Public address of this host, resolved once and revalidated in the background
+public_host = {'address': PUBLIC_HOST}
+
+# Deployment state store, shared by all threads
+state_db = None
+state_db_lock = threading.Lock()
+delivery_prune = {'last': 0}
+log_prune = {'last': 0}
+
+# Outgoing emails waiting for the email dispatcher
+email_queue = queue.Queue()
+
+# Deployment and cleanup results waiting for the next digest email
+email_digest = {'entries': [], 'attached_bytes': 0}
+email_digest_lock = threading.Lock()
+
+# Installation access tokens keyed by installation ID
+token_cache = {}
+token_locks = {}
+token_cache_lock = threading.Lock()
+
+# Signed GitHub App JWT, reused until shortly before it expires
+jwt_cache = {}
+jwt_lock = threading.Lock()
+
+# Modules imported on first use rather than at startup, preloaded by warm_up()
+LAZY_MODULES = ['jwt', 'yaml', 'smtplib', 'email.mime.multipart', 'email.mime.text', 'email.mime.base', 'email.encoders']
+
+# Shared keep-alive session for GitHub API calls and the App private key, both created on first use
+github_client = {}
+github_client_lock = threading.Lock()
+
+# Prometheus metrics
+STAGE_DURATION = Histogram(
+    'pr_testbot_stage_duration_seconds', 'Time spent in each deployment stage', ['stage'],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+)
+JOB_OUTCOMES = Counter('pr_testbot_jobs_total', 'Processed jobs by action and outcome', ['action', 'outcome'])
+GITHUB_REQUESTS = Counter('pr_testbot_github_requests_total', 'GitHub API requests by method and status', ['method', 'status'])
+GITHUB_ERRORS = Counter('pr_testbot_github_errors_total', 'GitHub API requests that failed or returned an error status')
+EMAILS_SENT = Counter('pr_testbot_emails_sent_total', 'Emails sent successfully')
+SMTP_ERRORS = Counter('pr_testbot_smtp_errors_total', 'Failed SMTP send attempts')
+QUEUE_DEPTH = Gauge('pr_testbot_queue_depth', 'Jobs waiting for a deployment worker')
+RUNNING_CONTAINERS = Gauge('pr_testbot_running_containers', 'Deployed containers that have not been cleaned up')
+
+# deploy.sh output lines that mark the start of each deployment stage
+STAGE_MARKERS = [
+    ('Updating the repository mirror', 'clone'),
+    ('Cloning the repository mirror', 'clone'),
+    ('using Docker for deployment', 'docker_build'),
+    ('using Docker Compose for deployment', 'compose_up'),
+    ('Running Docker container', 'docker_run')
+]
+
+# Sticky status comment per pull request, keyed by the PR's comments URL
+STATUS_COMMENT_MARKER = '<!-- pr_testbot:status -->'
+status_comments = {}
+status_comments_lock = threading.Lock()
+
+def get_private_key():
+    """Load the GitHub App private key on first use."""
+    with github_client_lock:
+        if 'private_key' not in github_client:
+            from cryptography.hazmat.primitives import serialization
+            from cryptography.hazmat.backends import default_backend
+            with open(PRIVATE_KEY_PATH, 'r') as key_file:
+                github_client['private_key'] = serialization.load_pem_private_key(
+                    key_file.read().encode(),
+                    password=None,
+                    backend=default_backend()
+                )
+        return github_client['private_key']
+
+def get_github_session():
+    """Create the shared GitHub session on first use, with one pooled connection per worker
+    plus headroom for the token refresher and request threads."""
+    with github_client_lock:
+        if 'session' not in github_client:
+            import requests
+            from requests.adapters import HTTPAdapter
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=DEPLOY_WORKERS + 2))
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=DEPLOY_WORKERS + 2))
+            github_client['session'] = session
+        return github_client['session']
+
+def warm_up():
+    """Import the heavy dependencies and load the private key ahead of the first webhook."""
+    started_at = time.time()
+    get_github_session()
+    get_private_key()
+    for module in LAZY_MODULES:
+        importlib.import_module(module)
+    logger.info(f"Warm-up completed in {time.time() - started_at:.2f}s")
+
+def github_request(method, url, **kwargs):
+    """Send a request to the GitHub API over the shared session with explicit timeouts."""
+    import requests
+    kwargs.setdefault('timeout', (GITHUB_CONNECT_TIMEOUT, GITHUB_READ_TIMEOUT))
+    try:
+        response = get_github_session().request(method, url, **kwargs)
+    except requests.RequestException:
+        GITHUB_REQUESTS.labels(method, 'error').inc()
+        GITHUB_ERRORS.inc()
+        raise
+    GITHUB_REQUESTS.labels(method, str(response.status_code)).inc()
+    if response.status_code >= 400:
+        GITHUB_ERRORS.inc()
+    return response
+
+class DeploymentSuperseded(Exception):
+    """Raised when a deployment is cancelled because a newer event arrived for its pull request."""
+
+    def __init__(self, job_id, container_name=None, deployment_url=None, image_name=None):
+        super().__init__(job_id)
+        # Whatever deploy.sh had already started before it was killed
+        self.container_name = container_name
+        self.deployment_url = deployment_url
+        self.image_name = image_name
 
 def verify_signature(payload, signature):
     """Verify GitHub webhook signature."""
@@ -52,130 +267,1111 @@ def verify_signature(payload, signature):
     return hmac.compare_digest('sha256=' + mac.hexdigest(), signature)
 
 def get_jwt_token():
-    """Create a JWT token for GitHub App authentication."""
-    current_time = int(time.time())
-    payload = {
-        'iat': current_time,
-        'exp': current_time + (10 * 60),  # 10 minute expiration
-        'iss': APP_ID
-    }
-    jwt_token = jwt.encode(payload, private_key, algorithm='RS256')
-    return jwt_token
+    """Create a JWT token for GitHub App authentication, reusing it until shortly before it expires."""
+    import jwt
+    with jwt_lock:
+        current_time = int(time.time())
+        if jwt_cache and jwt_cache['exp'] - current_time > JWT_REFRESH_MARGIN:
+            return jwt_cache['token']
+        payload = {
+            'iat': current_time,
+            'exp': current_time + (10 * 60),  # 10 minute expiration
+            'iss': APP_ID
+        }
+        jwt_token = jwt.encode(payload, get_private_key(), algorithm='RS256')
+        jwt_cache['token'] = jwt_token
+        jwt_cache['exp'] = payload['exp']
+        return jwt_token
 
-def get_installation_access_token(installation_id):
-    """Get the installation access token."""
+def request_installation_access_token(installation_id):
+    """Mint a new installation access token and return it with its expiry."""
     jwt_token = get_jwt_token()
     headers = {
         'Authorization': f'Bearer {jwt_token}',
         'Accept': 'application/vnd.github.v3+json'
     }
-    response = requests.post(
-        f'https://api.github.com/app/installations/{installation_id}/access_tokens',
-        headers=headers
-    )
+    with STAGE_DURATION.labels('token_mint').time():
+        response = github_request(
+            'POST',
+            f'{GITHUB_API_URL}/app/installations/{installation_id}/access_tokens',
+            headers=headers
+        )
     response.raise_for_status()
-    return response.json()['token']
+    token_data = response.json()
+    expires_at = datetime.strptime(token_data['expires_at'], '%Y-%m-%dT%H:%M:%SZ').replace(tzinfo=timezone.utc).timestamp()
+    return token_data['token'], expires_at
+
+def refresh_installation_access_token(installation_id, last_used=None):
+    """Mint a token for an installation and store it in the token cache."""
+    token, expires_at = request_installation_access_token(installation_id)
+    with token_cache_lock:
+        if last_used is None:
+            last_used = token_cache.get(installation_id, {}).get('last_used', time.time())
+        token_cache[installation_id] = {'token': token, 'expires_at': expires_at, 'last_used': last_used}
+    return token
+
+def get_installation_access_token(installation_id):
+    """Get the installation access token, reusing a cached one until shortly before it expires."""
+    with token_cache_lock:
+        lock = token_locks.setdefault(installation_id, threading.Lock())
+    # Only one thread per installation mints a token; the others wait and reuse it
+    with lock:
+        with token_cache_lock:
+            cached = token_cache.get(installation_id)
+            if cached and cached['expires_at'] - time.time() > TOKEN_REFRESH_MARGIN:
+                cached['last_used'] = time.time()
+                return cached['token']
+        return refresh_installation_access_token(installation_id, last_used=time.time())
+
+def token_refresher():
+    """Refresh cached tokens before they expire and evict idle installations."""
+    while True:
+        time.sleep(TOKEN_REFRESH_INTERVAL)
+        now = time.time()
+        with token_cache_lock:
+            entries = list(token_cache.items())
+        for installation_id, cached in entries:
+            if now - cached['last_used'] > TOKEN_IDLE_TTL:
+                with token_cache_lock:
+                    token_cache.pop(installation_id, None)
+                    token_locks.pop(installation_id, None)
+                logger.info(f"Evicted idle access token for installation {installation_id}")
+            elif cached['expires_at'] - now <= TOKEN_REFRESH_MARGIN + TOKEN_REFRESH_INTERVAL:
+                try:
+                    refresh_installation_access_token(installation_id)
+                    logger.info(f"Refreshed access token for installation {installation_id}")
+                except Exception as e:
+                    logger.error(f"Failed to refresh access token for installation {installation_id}: {e}")
 
 @app.route('/webhook', methods=['POST'])
 def webhook():
+    # Only pull request events with a handled action can trigger work, so answer
+    # everything else before hashing or parsing the body
+    if request.headers.get('X-GitHub-Event') != 'pull_request':
+        return jsonify({'message': 'No action taken'}), 200
+    action_match = ACTION_PATTERN.match(request.data)
+    if action_match and action_match.group(1).decode() not in HANDLED_ACTIONS:
+        return jsonify({'message': 'No action taken'}), 200
+
     # Verify payload signature
     signature = request.headers.get('X-Hub-Signature-256')
     if not verify_signature(request.data, signature):
         return jsonify({'message': 'Invalid signature'}), 401
 
-    data = request.json
+    data = json.loads(request.data)
     action = data.get('action')
-    if 'pull_request' in data:
-        pr_number = data['pull_request']['number']
-        repo_name = data['repository']['full_name']
-        repo_url = data['pull_request']['head']['repo']['clone_url']
-        branch_name = data['pull_request']['head']['ref']
-        installation_id = data['installation']['id']
-        comment_url = f"https://api.github.com/repos/{repo_name}/issues/{pr_number}/comments"
-        access_token = None
-
-        logger.info(f"Received webhook for PR #{pr_number} on branch '{branch_name}'")
-
-        if action in ['opened', 'synchronize', 'reopened']:
+    if 'pull_request' in data and action in HANDLED_ACTIONS:
+        # GitHub redelivers events on timeout; only accept each delivery once
+        delivery_id = request.headers.get('X-GitHub-Delivery')
+        if delivery_id and not claim_delivery(delivery_id):
+            logger.info(f"Ignoring duplicate delivery {delivery_id}")
+            return jsonify({'message': 'Duplicate delivery'}), 200
+
+        try:
+            job = {
+                'id': uuid.uuid4().hex,
+                'action': action,
+                'pr_number': data['pull_request']['number'],
+                'repo_name': data['repository']['full_name'],
+                'repo_url': data['pull_request']['head']['repo']['clone_url'],
+                'branch_name': data['pull_request']['head']['ref'],
+                'head_sha': data['pull_request']['head']['sha'],
+                'installation_id': data['installation']['id'],
+                'received_at': time.time()
+            }
+            logger.info(f"Received webhook for PR #{job['pr_number']} on branch '{job['branch_name']}'")
+
+            # Persist the job and hand it to the deployment workers
+            enqueue_job(job)
+        except Exception:
+            # Let GitHub's redelivery through, since this one was never persisted
+            if delivery_id:
+                release_delivery(delivery_id)
+            raise
+        return jsonify({'message': 'Job accepted', 'job_id': job['id']}), 202
+
+    return jsonify({'message': 'No action taken'}), 200
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(generate_latest(), mimetype=CONTENT_TYPE_LATEST)
+
+def get_queue_depth():
+    """Return the number of jobs waiting for a deployment worker."""
+    with job_condition:
+        return sum(len(jobs) for jobs in repo_queues.values())
+
+def count_running_containers():
+    """Return the number of deployed containers that have not been cleaned up."""
+    if state_db is None:
+        return 0
+    with state_db_lock:
+        return state_db.execute(
+            "SELECT COUNT(*) FROM deployments WHERE status = 'running' AND container_name IS NOT NULL"
+        ).fetchone()[0]
+
+def enqueue_job(job):
+    """Persist a job to the job directory and add it to the work queue."""
+    job_path = os.path.join(JOB_DIR, f"{job['id']}.json")
+    tmp_path = f'{job_path}.tmp'
+    with open(tmp_path, 'w') as job_file:
+        json.dump(job, job_file)
+    os.replace(tmp_path, job_path)
+    register_job(job)
+    if BASE_IMAGE_PREPULL and job['action'] != 'closed':
+        # Start pulling base images from the last mirrored copy while the job waits
+        refs = [ref for ref in (job.get('head_sha'), f"refs/heads/{job['branch_name']}", 'HEAD') if ref]
+        prepull_queue.put((get_mirror_path(job['repo_url']), refs))
+    if job['action'] == 'closed' or DEPLOY_DEBOUNCE <= 0:
+        schedule_job(job)
+    else:
+        # Hold deployments briefly so a burst of pushes collapses into one build
+        timer = threading.Timer(DEPLOY_DEBOUNCE, schedule_job, args=(job,))
+        timer.daemon = True
+        timer.start()
+
+def schedule_job(job):
+    """Add a job to its repository's queue."""
+    with job_condition:
+        repo_name = job['repo_name']
+        if repo_name not in repo_queues:
+            repo_queues[repo_name] = deque()
+            repo_order.append(repo_name)
+        repo_queues[repo_name].append(job)
+        job_condition.notify()
+
+def find_runnable_job(jobs):
+    """Return the index of the job a worker may take from a repository's queue, or None. Call with job_condition held."""
+    # Superseded deployments are only dropped by the worker, so they never need a build slot
+    head = jobs[0]
+    if head['action'] == 'closed' or is_superseded(head) or len(build_slots) < BUILD_CONCURRENCY:
+        return 0
+    # Deployments wait for a build slot in the queue rather than in a worker, but a cleanup can
+    # go ahead of them unless one of them is still a live deployment of the same pull request
+    waiting = set()
+    for index, job in enumerate(jobs):
+        pr_key = get_pr_key(job)
+        if job['action'] == 'closed' and pr_key not in waiting:
+            return index
+        if not is_superseded(job):
+            waiting.add(pr_key)
+    return None
+
+def next_job():
+    """Wait for and return the next job, taking one from each repository in turn."""
+    with job_condition:
+        while True:
+            for repo_name in repo_order:
+                index = find_runnable_job(repo_queues[repo_name])
+                if index is not None:
+                    break
+            else:
+                job_condition.wait()
+                continue
+            repo_order.remove(repo_name)
+            jobs = repo_queues[repo_name]
+            job = jobs[index]
+            del jobs[index]
+            if jobs:
+                repo_order.append(repo_name)
+            else:
+                del repo_queues[repo_name]
+            if job['action'] != 'closed' and not is_superseded(job):
+                build_slots.add(job['id'])
+            return job
+
+def release_build_slot(job):
+    """Free the build slot a deployment job took when it was dequeued, if it took one."""
+    with job_condition:
+        if job['id'] in build_slots:
+            build_slots.discard(job['id'])
+            job_condition.notify()
+
+def complete_job(job):
+    """Remove a finished job from the job directory."""
+    try:
+        os.remove(os.path.join(JOB_DIR, f"{job['id']}.json"))
+    except FileNotFoundError:
+        pass
+
+def recover_jobs():
+    """Re-queue jobs that were accepted but not finished before a restart."""
+    jobs = []
+    for file_name in os.listdir(JOB_DIR):
+        if not file_name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(JOB_DIR, file_name), 'r') as job_file:
+                jobs.append(json.load(job_file))
+        except (OSError, ValueError) as e:
+            logger.error(f"Failed to load job {file_name}: {e}")
+    for job in sorted(jobs, key=lambda j: j.get('received_at', 0)):
+        register_job(job)
+        schedule_job(job)
+    if jobs:
+        logger.info(f"Recovered {len(jobs)} pending job(s)")
+
+def get_pr_key(job):
+    """Return the key identifying the pull request a job belongs to."""
+    return f"{job['repo_name']}#{job['pr_number']}"
+
+def register_job(job):
+    """Record a job as the newest for its pull request and cancel the build it supersedes."""
+    pr_key = get_pr_key(job)
+    with pr_state_lock:
+        latest_jobs[pr_key] = job['id']
+        running = running_deployments.get(pr_key)
+    if running and running['job_id'] != job['id']:
+        logger.info(f"Cancelling deployment {running['job_id']} for {pr_key}, superseded by {job['id']}")
+        try:
+            os.killpg(running['process'].pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+def is_superseded(job):
+    """Check whether a newer event has arrived for the job's pull request."""
+    with pr_state_lock:
+        return latest_jobs.get(get_pr_key(job)) != job['id']
+
+def deployment_worker():
+    """Drain the job queue, processing one job at a time."""
+    while True:
+        job = next_job()
+        pr_key = get_pr_key(job)
+        with pr_state_lock:
+            pr_lock = pr_locks.setdefault(pr_key, threading.Lock())
+        try:
+            if job['action'] != 'closed' and is_superseded(job):
+                logger.info(f"Dropping deployment {job['id']} for {pr_key}, superseded by a newer event")
+                JOB_OUTCOMES.labels(job['action'], 'superseded').inc()
+                continue
+            # Never run two jobs for the same pull request at once
+            with pr_lock:
+                process_job(job)
+        except Exception as e:
+            logger.error(f"Job {job['id']} failed: {e}")
+        finally:
+            release_build_slot(job)
+            complete_job(job)
+            if job['action'] == 'closed':
+                with pr_state_lock:
+                    if latest_jobs.get(pr_key) == job['id']:
+                        del latest_jobs[pr_key]
+
+def start_workers():
+    """Start the deployment worker pool."""
+    os.makedirs(JOB_DIR, exist_ok=True)
+    init_state_store()
+    QUEUE_DEPTH.set_function(get_queue_depth)
+    RUNNING_CONTAINERS.set_function(count_running_containers)
+    load_port_allocations()
+    recover_jobs()
+    threading.Thread(target=reconcile_deployments, name='reconciler', daemon=True).start()
+    for i in range(DEPLOY_WORKERS):
+        threading.Thread(target=deployment_worker, name=f'deploy-worker-{i}', daemon=True).start()
+    threading.Thread(target=token_refresher, name='token-refresher', daemon=True).start()
+    threading.Thread(target=email_dispatcher, name='email-dispatcher', daemon=True).start()
+    if EMAIL_DIGEST_INTERVAL > 0:
+        threading.Thread(target=email_digest_sender, name='email-digest-sender', daemon=True).start()
+    if not PUBLIC_HOST:
+        threading.Thread(target=public_host_refresher, name='public-host-refresher', daemon=True).start()
+    if BASE_IMAGE_PREPULL:
+        for i in range(BASE_IMAGE_PULL_WORKERS):
+            threading.Thread(target=prepull_worker, name=f'prepull-worker-{i}', daemon=True).start()
+        threading.Thread(target=prepull_scheduler, name='prepull-scheduler', daemon=True).start()
+    if WARM_UP:
+        threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+    logger.info(f"Started {DEPLOY_WORKERS} deployment worker(s)")
+
+def load_port_allocations():
+    """Load reserved ports from the port state file."""
+    global port_cursor
+    try:
+        with open(PORT_STATE_FILE, 'r') as state_file:
+            allocations = json.load(state_file)
+    except FileNotFoundError:
+        return
+    except (OSError, ValueError) as e:
+        logger.error(f"Failed to load port allocations: {e}")
+        return
+    with port_lock:
+        for port, owner in allocations.items():
+            port = int(port)
+            if PORT_RANGE_START <= port <= PORT_RANGE_END:
+                port_bitmap[port - PORT_RANGE_START] = 1
+                port_owners[port] = owner
+        port_cursor = 0
+    logger.info(f"Loaded {len(port_owners)} reserved port(s)")
+
+def save_port_allocations():
+    """Write reserved ports to the port state file. Must be called with the port lock held."""
+    tmp_path = f'{PORT_STATE_FILE}.tmp'
+    with open(tmp_path, 'w') as state_file:
+        json.dump(port_owners, state_file)
+    os.replace(tmp_path, PORT_STATE_FILE)
+
+def is_port_bindable(port):
+    """Check that no process outside the bot is listening on a port."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        try:
+            sock.bind(('0.0.0.0', port))
+        except OSError:
+            return False
+    return True
+
+def allocate_port(owner, check_bindable=True):
+    """Reserve a free port in the deployment range for the given owner."""
+    global port_cursor
+    with port_lock:
+        size = len(port_bitmap)
+        # Next-fit scan from the last allocation, so allocation is O(1) amortised
+        for offset in range(size):
+            index = (port_cursor + offset) % size
+            if port_bitmap[index]:
+                continue
+            port = PORT_RANGE_START + index
+            if check_bindable and not is_port_bindable(port):
+                continue
+            port_bitmap[index] = 1
+            port_owners[port] = owner
+            port_cursor = (index + 1) % size
+            save_port_allocations()
+            return port
+    raise RuntimeError(f"No free port available in range {PORT_RANGE_START}-{PORT_RANGE_END}")
+
+def release_port(port):
+    """Return a single port to the pool."""
+    with port_lock:
+        if port_owners.pop(port, None) is not None:
+            port_bitmap[port - PORT_RANGE_START] = 0
+            save_port_allocations()
+
+def release_ports(owner):
+    """Return every port reserved by the given owner to the pool."""
+    with port_lock:
+        ports = [port for port, port_owner in port_owners.items() if port_owner == owner]
+        for port in ports:
+            del port_owners[port]
+            port_bitmap[port - PORT_RANGE_START] = 0
+        if ports:
+            save_port_allocations()
+
+def resolve_public_host():
+    """Look up this host's public IP address and cache it."""
+    import requests
+    if PUBLIC_HOST:
+        return PUBLIC_HOST
+    try:
+        response = requests.get('https://api.ipify.org', timeout=(GITHUB_CONNECT_TIMEOUT, GITHUB_READ_TIMEOUT))
+        response.raise_for_status()
+        address = response.text.strip()
+    except requests.RequestException as e:
+        # Keep using the last known address when the lookup fails
+        logger.error(f"Failed to resolve public host address: {e}")
+        return public_host['address']
+    if address != public_host['address']:
+        logger.info(f"Public host address is {address}")
+    public_host['address'] = address
+    return address
+
+def public_host_refresher():
+    """Resolve the public host address, then periodically revalidate it."""
+    while True:
+        resolve_public_host()
+        time.sleep(PUBLIC_HOST_REFRESH_INTERVAL)
+
+def init_state_store():
+    """Open the deployment state database and create its schema."""
+    global state_db
+    state_db = sqlite3.connect(STATE_DB_PATH, check_same_thread=False)
+    state_db.row_factory = sqlite3.Row
+    with state_db_lock, state_db:
+        state_db.execute('PRAGMA journal_mode=WAL')
+        state_db.execute('''
+            CREATE TABLE IF NOT EXISTS deployments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                repo_name TEXT NOT NULL,
+                pr_number INTEGER NOT NULL,
+                branch_name TEXT,
+                head_sha TEXT,
+                container_name TEXT,
+                image_name TEXT,
+                port INTEGER,
+                workspace TEXT,
+                docker_host TEXT,
+                deployment_url TEXT,
+                status TEXT NOT NULL,
+                created_at REAL NOT NULL,
+                updated_at REAL NOT NULL
+            )
+        ''')
+        columns = [row['name'] for row in state_db.execute('PRAGMA table_info(deployments)')]
+        if 'docker_host' not in columns:
+            state_db.execute('ALTER TABLE deployments ADD COLUMN docker_host TEXT')
+        state_db.execute('CREATE INDEX IF NOT EXISTS idx_deployments_pr ON deployments (repo_name, pr_number, status)')
+        state_db.execute('CREATE INDEX IF NOT EXISTS idx_deployments_sha ON deployments (repo_name, head_sha)')
+        state_db.execute('CREATE TABLE IF NOT EXISTS deliveries (delivery_id TEXT PRIMARY KEY, received_at REAL NOT NULL)')
+        state_db.execute('CREATE INDEX IF NOT EXISTS idx_deliveries_received ON deliveries (received_at)')
+
+def record_deployment(job, status, container_name=None, image_name=None, port=None, workspace=None, deployment_url=None, docker_host=None):
+    """Store the outcome of a deployment in the state database."""
+    now = time.time()
+    with state_db_lock, state_db:
+        state_db.execute(
+            '''INSERT INTO deployments (repo_name, pr_number, branch_name, head_sha, container_name, image_name,
+               port, workspace, docker_host, deployment_url, status, created_at, updated_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)''',
+            (job['repo_name'], job['pr_number'], job['branch_name'], job.get('head_sha'), container_name, image_name,
+             port, workspace, docker_host, deployment_url, status, now, now)
+        )
+
+def claim_delivery(delivery_id):
+    """Record a webhook delivery ID, returning False if it was already accepted."""
+    now = time.time()
+    with state_db_lock, state_db:
+        cursor = state_db.execute('INSERT OR IGNORE INTO deliveries (delivery_id, received_at) VALUES (?, ?)', (delivery_id, now))
+        # Expire old deliveries and cap the table size at most once a minute
+        if now - delivery_prune['last'] > 60:
+            delivery_prune['last'] = now
+            state_db.execute('DELETE FROM deliveries WHERE received_at < ?', (now - DELIVERY_TTL,))
+            state_db.execute(
+                'DELETE FROM deliveries WHERE received_at <= (SELECT received_at FROM deliveries ORDER BY received_at DESC LIMIT 1 OFFSET ?)',
+                (DELIVERY_CACHE_SIZE,)
+            )
+    return cursor.rowcount == 1
+
+def release_delivery(delivery_id):
+    """Forget a webhook delivery ID so a redelivery of it is accepted."""
+    with state_db_lock, state_db:
+        state_db.execute('DELETE FROM deliveries WHERE delivery_id = ?', (delivery_id,))
+
+def get_last_deployment(repo_name, pr_number):
+    """Return the most recent deployment attempt of a pull request, if any."""
+    with state_db_lock:
+        return state_db.execute(
+            "SELECT * FROM deployments WHERE repo_name = ? AND pr_number = ? ORDER BY id DESC LIMIT 1",
+            (repo_name, pr_number)
+        ).fetchone()
+
+def get_active_deployments(repo_name, pr_number):
+    """Return the running deployments of a pull request."""
+    with state_db_lock:
+        return state_db.execute(
+            "SELECT * FROM deployments WHERE repo_name = ? AND pr_number = ? AND status = 'running'",
+            (repo_name, pr_number)
+        ).fetchall()
+
+def mark_deployments_removed(repo_name, pr_number):
+    """Mark every running deployment of a pull request as removed."""
+    with state_db_lock, state_db:
+        state_db.execute(
+            "UPDATE deployments SET status = 'removed', updated_at = ? WHERE repo_name = ? AND pr_number = ? AND status = 'running'",
+            (time.time(), repo_name, pr_number)
+        )
+
+def reconcile_deployments():
+    """Mark running deployments whose containers no longer exist as removed and free their ports."""
+    with state_db_lock:
+        rows = state_db.execute(
+            "SELECT id, container_name, port, docker_host FROM deployments WHERE status = 'running' AND container_name IS NOT NULL"
+        ).fetchall()
+    by_host = {}
+    for row in rows:
+        by_host.setdefault(row['docker_host'], []).append(row)
+
+    for docker_host, deployments in by_host.items():
+        env = dict(os.environ)
+        if docker_host:
+            env['DOCKER_HOST'] = docker_host
+        try:
+            result = subprocess.run(['docker', 'ps', '-a', '--format', '{{.Names}}'], capture_output=True, text=True, env=env, timeout=30)
+        except (OSError, subprocess.TimeoutExpired) as e:
+            logger.warning(f"Skipping reconciliation for Docker engine {docker_host or 'local'}: {e}")
+            continue
+        if result.returncode != 0:
+            logger.warning(f"Skipping reconciliation for Docker engine {docker_host or 'local'}: {result.stderr.strip()}")
+            continue
+        existing = set(result.stdout.split())
+        missing = [row for row in deployments if row['container_name'] not in existing]
+        if not missing:
+            continue
+        with state_db_lock, state_db:
+            state_db.executemany(
+                "UPDATE deployments SET status = 'removed', updated_at = ? WHERE id = ?",
+                [(time.time(), row['id']) for row in missing]
+            )
+        for row in missing:
+            if row['port']:
+                release_port(row['port'])
+        logger.info(f"Reconciled {len(missing)} deployment(s) whose containers are gone from Docker engine {docker_host or 'local'}")
+
+def get_workspace(repo_name, pr_number):
+    """Return the checkout directory used for a pull request's deployments."""
+    return os.path.join(WORKSPACE_ROOT, f"pr_testbot-{repo_name.replace('/', '_')}-{pr_number}")
+
+def get_log_path(kind, pr_number, repo_name=None, job_id=None):
+    """Return a new log file path for a job, removing logs past their retention at most once an hour."""
+    os.makedirs(LOG_DIR, exist_ok=True)
+    now = time.time()
+    if now - log_prune['last'] > 3600:
+        log_prune['last'] = now
+        for name in os.listdir(LOG_DIR):
+            path = os.path.join(LOG_DIR, name)
             try:
-                # Get installation access token
-                access_token = get_installation_access_token(installation_id)
+                if now - os.path.getmtime(path) > LOG_RETENTION:
+                    os.remove(path)
+            except OSError:
+                pass
+    # Each job gets its own file, so a log stays available after the PR's next deployment
+    repo = (repo_name or 'unknown').replace('/', '_')
+    return os.path.join(LOG_DIR, f"{kind}_log_{repo}_{pr_number}_{job_id or uuid.uuid4().hex}.txt")
 
-                # Notify stakeholders (comment on the PR)
-                notify_stakeholders(comment_url, "Deployment started for this pull request.", access_token)
+def get_docker_host_url(entry):
+    """Return the DOCKER_HOST URL of a DOCKER_HOSTS entry."""
+    return entry.partition('=')[0]
 
-                # Run the deployment script with the branch name, PR number, and repository URL
-                container_name, deployment_link, log_file_path = run_deployment_script(branch_name, pr_number, repo_url, comment_url, access_token)
+def get_docker_host_address(docker_host):
+    """Return the public address deployments on a Docker engine are reachable at."""
+    for entry in DOCKER_HOSTS:
+        url, _, address = entry.partition('=')
+        if url == docker_host and address:
+            return address
+    if docker_host and docker_host.startswith(('tcp://', 'ssh://')):
+        return urlparse(docker_host).hostname
+    return public_host['address']
 
-                # Notify stakeholders with the result
-                if deployment_link:
-                    deployment_message = f"Deployment successful. [Deployed application]({deployment_link})."
-                else:
-                    deployment_message = "Deployment failed. Please check the logs."
-                notify_stakeholders(comment_url, deployment_message, access_token)
+def get_docker_host_load(docker_host):
+    """Return the running container count and total memory reported by a Docker engine."""
+    env = dict(os.environ, DOCKER_HOST=docker_host)
+    try:
+        result = subprocess.run(['docker', 'info', '--format', '{{.ContainersRunning}} {{.MemTotal}}'], capture_output=True, text=True, env=env, timeout=10)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        logger.error(f"Failed to query Docker engine {docker_host}: {e}")
+        return None
+    if result.returncode != 0:
+        logger.error(f"Failed to query Docker engine {docker_host}: {result.stderr.strip()}")
+        return None
+    try:
+        running, mem_total = result.stdout.split()
+        return int(running), int(mem_total)
+    except ValueError:
+        logger.error(f"Unexpected output from Docker engine {docker_host}: {result.stdout.strip()!r}")
+        return None
 
-                # Send deployment log via email
-                send_email(RECIPIENT_EMAIL, 'Deployment Log', 'Please find the attached deployment log.', log_file_path)
+def acquire_docker_host(preferred_host=None):
+    """Pick the preferred Docker engine if it is reachable, else the least-loaded one, or None to use the local default."""
+    if not DOCKER_HOSTS:
+        return None
+    best_host = None
+    best_score = None
+    for entry in DOCKER_HOSTS:
+        docker_host = get_docker_host_url(entry)
+        load = get_docker_host_load(docker_host)
+        if load is None:
+            continue
+        if docker_host == preferred_host:
+            best_host = docker_host
+            break
+        running, mem_total = load
+        with docker_host_lock:
+            # Count deployments already heading to this engine so concurrent jobs spread out
+            running += docker_host_inflight.get(docker_host, 0)
+        score = (running, -mem_total / (running + 1))
+        if best_score is None or score < best_score:
+            best_host, best_score = docker_host, score
+    if best_host is None:
+        raise RuntimeError("No Docker engine is reachable")
+    with docker_host_lock:
+        docker_host_inflight[best_host] = docker_host_inflight.get(best_host, 0) + 1
+    logger.info(f"Scheduling deployment onto Docker engine {best_host}")
+    return best_host
 
-                return jsonify({'message': 'Deployment processed'}), 200
-            except Exception as e:
-                logger.error(f"Deployment failed: {e}")
-                if access_token:
-                    notify_stakeholders(comment_url, f"Deployment failed: {e}", access_token)
-                return jsonify({'message': 'Deployment failed'}), 500
+def release_docker_host(docker_host):
+    """Mark a deployment scheduled onto a Docker engine as finished."""
+    if docker_host is None:
+        return
+    with docker_host_lock:
+        docker_host_inflight[docker_host] -= 1
 
-        elif action == 'closed':
+def get_mirror_path(repo_url):
+    """Return the bare mirror deploy.sh keeps for a repository URL."""
+    return os.path.join(MIRROR_DIR, re.sub(r'[/:@]', '_', re.sub(r'^[a-z]*://', '', repo_url)))
+
+def find_base_images(mirror_path, refs):
+    """Return the base images referenced by Dockerfiles and compose files at the first ref that exists."""
+    import yaml
+    git = ['git', '-c', 'safe.directory=*', '--git-dir', mirror_path]
+    for ref in refs:
+        files = subprocess.run(git + ['ls-tree', '-r', '--name-only', ref], capture_output=True, text=True, timeout=60)
+        if files.returncode == 0:
+            break
+    else:
+        return set()
+
+    images = set()
+    for path in files.stdout.splitlines():
+        name = os.path.basename(path).lower()
+        is_dockerfile = name.startswith('dockerfile') or name.endswith('.dockerfile')
+        is_compose_file = name.startswith(('docker-compose', 'compose')) and name.endswith(('.yml', '.yaml'))
+        if not is_dockerfile and not is_compose_file:
+            continue
+        content = subprocess.run(git + ['show', f'{ref}:{path}'], capture_output=True, text=True, timeout=60).stdout
+        if is_compose_file:
             try:
-                # Get installation access token
-                access_token = get_installation_access_token(installation_id)
+                compose = yaml.safe_load(content)
+            except yaml.YAMLError:
+                continue
+            services = compose.get('services') if isinstance(compose, dict) else None
+            for service in (services or {}).values():
+                # A service that is built locally uses image: as the tag for its build, not as an image to pull
+                if not isinstance(service, dict) or service.get('build'):
+                    continue
+                image = service.get('image')
+                if isinstance(image, str) and '$' not in image:
+                    images.add(image)
+            continue
+        # Later stages can build FROM an earlier stage's alias, which is not an image to pull
+        stages = set()
+        for match in FROM_PATTERN.finditer(content):
+            image, stage = match.group(1), match.group(2)
+            if '$' not in image and image.lower() != 'scratch' and image.lower() not in stages:
+                images.add(image)
+            if stage:
+                stages.add(stage.lower())
+    return images
 
-                # Pull request closed, trigger cleanup regardless of merge status
-                log_file_path = run_cleanup_script(branch_name, pr_number, comment_url, access_token)
-                
-                # Notify stakeholders about the cleanup
-                notify_stakeholders(comment_url, "Cleanup completed for this pull request.", access_token)
+def pull_base_image(image, docker_host):
+    """Pull an image onto a Docker engine unless it was pulled there recently."""
+    key = (docker_host, image)
+    with pulled_images_lock:
+        if time.time() - pulled_images.get(key, 0) < BASE_IMAGE_REFRESH_INTERVAL:
+            return
+        pulled_images[key] = time.time()
+    env = dict(os.environ)
+    if docker_host:
+        env['DOCKER_HOST'] = docker_host
+    try:
+        with STAGE_DURATION.labels('base_image_pull').time():
+            result = subprocess.run(['docker', 'pull', '-q', image], capture_output=True, text=True, env=env, timeout=900)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        result = None
+        error = str(e)
+    else:
+        error = result.stderr.strip()
+    if result is None or result.returncode != 0:
+        logger.warning(f"Failed to pre-pull base image {image}: {error}")
+        with pulled_images_lock:
+            pulled_images.pop(key, None)
+    else:
+        logger.info(f"Pre-pulled base image {image}")
 
-                # Send cleanup log via email
-                send_email(RECIPIENT_EMAIL, 'Cleanup Log', 'Please find the attached cleanup log.', log_file_path)
+def prepull_worker():
+    """Pull the base images of queued repositories onto every Docker engine."""
+    while True:
+        mirror_path, refs = prepull_queue.get()
+        try:
+            if os.path.isdir(mirror_path):
+                docker_hosts = [get_docker_host_url(entry) for entry in DOCKER_HOSTS] or [None]
+                for image in find_base_images(mirror_path, refs):
+                    for docker_host in docker_hosts:
+                        pull_base_image(image, docker_host)
+        except Exception as e:
+            logger.error(f"Base image pre-pull failed for {mirror_path}: {e}")
 
-                return jsonify({'message': 'Cleanup processed'}), 200
-            except Exception as e:
-                logger.error(f"Cleanup failed: {e}")
-                if access_token:
-                    notify_stakeholders(comment_url, f"Cleanup failed: {e}", access_token)
-                return jsonify({'message': 'Cleanup failed'}), 500
+def prepull_scheduler():
+    """Periodically queue every mirrored repository for a base image refresh."""
+    while True:
+        if os.path.isdir(MIRROR_DIR):
+            for name in os.listdir(MIRROR_DIR):
+                mirror_path = os.path.join(MIRROR_DIR, name)
+                if os.path.isdir(mirror_path):
+                    prepull_queue.put((mirror_path, ['HEAD']))
+        time.sleep(BASE_IMAGE_PULL_INTERVAL)
 
-    return jsonify({'message': 'No action taken'}), 200
+def get_changed_files(repo_name, base_sha, head_sha, access_token):
+    """Return the paths changed by commits added on top of base_sha, or None if GitHub cannot list them all."""
+    headers = {
+        'Authorization': f'token {access_token}',
+        'Accept': 'application/vnd.github.v3+json'
+    }
+    response = github_request('GET', f"{GITHUB_API_URL}/repos/{repo_name}/compare/{base_sha}...{head_sha}", headers=headers)
+    if response.status_code != 200:
+        logger.warning(f"Failed to compare {base_sha}...{head_sha} in {repo_name}: {response.status_code}")
+        return None
+    comparison = response.json()
+    # The files are listed from the merge base, which only matches the deployed commit when the
+    # push moved the branch forward; a force-push or a reset needs a full redeploy
+    if comparison.get('status') != 'ahead':
+        logger.info(f"Comparing {base_sha}...{head_sha} in {repo_name} gave status {comparison.get('status')}, redeploying every service")
+        return None
+    files = comparison.get('files', [])
+    # The compare API lists at most 300 files, beyond that the change set is incomplete
+    if len(files) >= 300:
+        return None
+    paths = set()
+    for entry in files:
+        paths.add(entry['filename'])
+        if entry.get('previous_filename'):
+            paths.add(entry['previous_filename'])
+    return paths
+
+def is_path_under(path, directory):
+    """Return True if a repository path lies inside a repository directory."""
+    return directory == '.' or path == directory or path.startswith(directory + '/')
+
+def get_affected_services(job, access_token, docker_host):
+    """Return the compose services a push touched, or None if the whole stack should be redeployed."""
+    import yaml
+    previous = get_last_deployment(job['repo_name'], job['pr_number'])
+    head_sha = job.get('head_sha')
+    # Only a push on top of a running stack on the same Docker engine can be applied incrementally
+    if (not INCREMENTAL_COMPOSE_DEPLOY or job['action'] != 'synchronize' or not head_sha or previous is None
+            or previous['status'] != 'running' or previous['container_name'] or not previous['head_sha']
+            or previous['docker_host'] != docker_host or previous['head_sha'] == head_sha):
+        return None
+
+    # Read the compose file the running stack was deployed from out of the local mirror
+    git = ['git', '-c', 'safe.directory=*', '--git-dir', get_mirror_path(job['repo_url'])]
+    for compose_file in COMPOSE_FILES:
+        result = subprocess.run(git + ['show', f"{previous['head_sha']}:{compose_file}"], capture_output=True, text=True, timeout=60)
+        if result.returncode == 0:
+            break
+    else:
+        return None
+
+    changed = get_changed_files(job['repo_name'], previous['head_sha'], head_sha, access_token)
+    if changed is None or any(path in COMPOSE_SHARED_FILES for path in changed):
+        return None
+    try:
+        services = (yaml.safe_load(result.stdout) or {}).get('services') or {}
+    except yaml.YAMLError:
+        return None
+
+    affected = []
+    for name, service in services.items():
+        service = service or {}
+        build = service.get('build')
+        context = build.get('context', '.') if isinstance(build, dict) else build
+        env_files = service.get('env_file') or []
+        if isinstance(env_files, (str, dict)):
+            env_files = [env_files]
+        sources = [env_file.get('path') if isinstance(env_file, dict) else env_file for env_file in env_files]
+        # Bind-mounted files and directories from the repository, in the short and long volume syntax
+        for volume in service.get('volumes') or []:
+            if isinstance(volume, str):
+                source = volume.split(':', 1)[0] if ':' in volume else None
+                if source and source.startswith('.'):
+                    sources.append(source)
+            elif isinstance(volume, dict) and volume.get('type') == 'bind':
+                sources.append(volume.get('source'))
+        watched = [os.path.normpath(str(path)) for path in sources
+                   if path and '$' not in str(path) and not os.path.isabs(str(path)) and not str(path).startswith('~')]
+        if context:
+            context = str(context)
+            # Remote or interpolated build contexts cannot be mapped to repository paths
+            if '://' in context or '$' in context or os.path.isabs(context):
+                affected.append(name)
+                continue
+            watched.append(os.path.normpath(context))
+        if any(is_path_under(path, directory) for path in changed for directory in watched):
+            affected.append(name)
+    return affected
+
+def process_job(job):
+    """Run the deployment or cleanup for a queued pull request event."""
+    action = job['action']
+    pr_number = job['pr_number']
+    repo_name = job['repo_name']
+    repo_url = job['repo_url']
+    branch_name = job['branch_name']
+    head_sha = job.get('head_sha')
+    installation_id = job['installation_id']
+    comment_url = f"{GITHUB_API_URL}/repos/{repo_name}/issues/{pr_number}/comments"
+    workspace = get_workspace(repo_name, pr_number)
+    access_token = None
+
+    if action in DEPLOY_ACTIONS:
+        port = None
+        container_name = None
+        docker_host = None
+        try:
+            # Get installation access token
+            access_token = get_installation_access_token(installation_id)
+
+            # Notify stakeholders (comment on the PR)
+            reset_status_comment(comment_url)
+            notify_stakeholders(comment_url, "Deployment started for this pull request.", access_token)
+
+            # Choose a Docker engine and reserve a port on it for the container. A running compose
+            # stack stays on its engine so it is updated in place rather than started a second time.
+            previous = get_last_deployment(repo_name, pr_number)
+            preferred_host = previous['docker_host'] if previous and previous['status'] == 'running' and not previous['container_name'] else None
+            docker_host = acquire_docker_host(preferred_host)
+            port = allocate_port(get_pr_key(job), check_bindable=docker_host is None or docker_host.startswith('unix://'))
+            # A push to a running compose stack only rebuilds the services it touched
+            services = get_affected_services(job, access_token, docker_host)
+            # Run the deployment script with the branch name, PR number, and repository URL
+            container_name, deployment_link, log_file_path, image_name = run_deployment_script(branch_name, pr_number, repo_url, comment_url, access_token, job, head_sha, port, workspace, docker_host, services)
+
+            # Record the deployment so cleanup and status lookups can find it
+            if deployment_link:
+                record_deployment(job, 'running', container_name, image_name, port if container_name else None, workspace, deployment_link, docker_host)
+            else:
+                record_deployment(job, 'failed', workspace=workspace, docker_host=docker_host)
+
+            # Notify stakeholders with the result
+            if deployment_link:
+                deployment_message = f"Deployment successful. [Deployed application]({deployment_link})."
+            else:
+                deployment_message = "Deployment failed. Please check the logs."
+            notify_stakeholders(comment_url, deployment_message, access_token)
+            JOB_OUTCOMES.labels(action, 'success' if deployment_link else 'failed').inc()
+
+            # Send deployment log via email
+            report_result('Deployment Log', 'Please find the attached deployment log.',
+                          f"{repo_name}#{pr_number} ({branch_name}): {deployment_message}", log_file_path, failed=not deployment_link)
+        except DeploymentSuperseded as e:
+            # The newer job reports on the pull request instead
+            logger.info(f"Deployment {job['id']} was superseded by a newer event")
+            JOB_OUTCOMES.labels(action, 'superseded').inc()
+            # Record anything already started so it keeps its port and is removed when the PR closes
+            if e.container_name or e.deployment_url:
+                container_name = e.container_name
+                record_deployment(job, 'running', container_name, e.image_name, port if container_name else None, workspace, e.deployment_url, docker_host)
+        except Exception as e:
+            logger.error(f"Deployment failed: {e}")
+            JOB_OUTCOMES.labels(action, 'error').inc()
+            if access_token:
+                notify_stakeholders(comment_url, f"Deployment failed: {e}", access_token)
+        finally:
+            # Only a running single-container deployment keeps its port
+            if port and not container_name:
+                release_port(port)
+            release_docker_host(docker_host)
+
+    elif action == 'closed':
+        try:
+            # Get installation access token
+            access_token = get_installation_access_token(installation_id)
+
+            # Pull request closed, trigger cleanup regardless of merge status
+            reset_status_comment(comment_url)
+            # Group the PR's containers by the Docker engine they were deployed to
+            targets = {}
+            for deployment in get_active_deployments(repo_name, pr_number):
+                container_names = targets.setdefault(deployment['docker_host'], [])
+                if deployment['container_name']:
+                    container_names.append(deployment['container_name'])
+            log_file_path = run_cleanup_script(branch_name, pr_number, comment_url, access_token, targets, workspace, job)
+            mark_deployments_removed(repo_name, pr_number)
+            release_ports(get_pr_key(job))
+
+            # Notify stakeholders about the cleanup
+            notify_stakeholders(comment_url, "Cleanup completed for this pull request.", access_token)
+            JOB_OUTCOMES.labels(action, 'success').inc()
+
+            # Send cleanup log via email
+            report_result('Cleanup Log', 'Please find the attached cleanup log.',
+                          f"{repo_name}#{pr_number} ({branch_name}): Cleanup completed.", log_file_path)
+        except Exception as e:
+            logger.error(f"Cleanup failed: {e}")
+            JOB_OUTCOMES.labels(action, 'error').inc()
+            if access_token:
+                notify_stakeholders(comment_url, f"Cleanup failed: {e}", access_token)
+        finally:
+            # The pull request is closed, so no further updates will follow
+            close_status_comment(comment_url)
 
 def notify_stakeholders(comment_url, message, access_token, details=None):
+    """Update the pull request's status comment, coalescing rapid updates into one write."""
+    with status_comments_lock:
+        status = status_comments.setdefault(comment_url, {
+            'lock': threading.Lock(),
+            'url': None,
+            'message': '',
+            'details': '',
+            'written_body': None,
+            'last_write': 0,
+            'timer': None
+        })
+    with status['lock']:
+        status['message'] = message
+        status['access_token'] = access_token
+        if details:
+            table = "| Step | Status | Details |\n|------|--------|---------|\n"
+            for step, detail in details.items():
+                table += f"| {step} | {detail['status']} | {detail['message']} |\n"
+            status['details'] = table
+        delay = status['last_write'] + STATUS_UPDATE_INTERVAL - time.time()
+        if delay <= 0:
+            write_status_comment(comment_url, status)
+        elif status['timer'] is None:
+            status['timer'] = threading.Timer(delay, flush_status_comment, args=(comment_url,))
+            status['timer'].daemon = True
+            status['timer'].start()
+
+def reset_status_comment(comment_url):
+    """Clear the step table of a pull request's status comment before a new run."""
+    with status_comments_lock:
+        status = status_comments.get(comment_url)
+    if status:
+        with status['lock']:
+            status['details'] = ''
+
+def flush_status_comment(comment_url):
+    """Write any pending status update that was held back by coalescing."""
+    with status_comments_lock:
+        status = status_comments.get(comment_url)
+    if status:
+        with status['lock']:
+            status['timer'] = None
+            write_status_comment(comment_url, status)
+
+def close_status_comment(comment_url):
+    """Write the final status update immediately and forget the pull request's comment."""
+    with status_comments_lock:
+        status = status_comments.pop(comment_url, None)
+    if status:
+        with status['lock']:
+            if status['timer']:
+                status['timer'].cancel()
+                status['timer'] = None
+            write_status_comment(comment_url, status)
+
+def find_status_comment(comment_url, headers):
+    """Return the API URL of the bot's existing status comment on the pull request, if any."""
+    url = comment_url
+    params = {'per_page': 100}
+    while url:
+        response = github_request('GET', url, headers=headers, params=params)
+        if response.status_code != 200:
+            return None
+        for comment in response.json():
+            # Anyone can post a comment starting with the marker, but only the bot's own can be edited
+            if comment.get('user', {}).get('type') == 'Bot' and comment.get('body', '').startswith(STATUS_COMMENT_MARKER):
+                return comment['url']
+        # The next page's URL already carries the query parameters
+        url = response.links.get('next', {}).get('url')
+        params = None
+    return None
+
+def write_status_comment(comment_url, status):
+    """Create or update the status comment. Must be called with the status lock held."""
+    import requests
+    body = f"{STATUS_COMMENT_MARKER}\n{status['message']}"
+    if status['details']:
+        body += f"\n\n{status['details']}"
+    if body == status['written_body']:
+        return
     headers = {
-        'Authorization': f'token {access_token}',
+        'Authorization': f"token {status['access_token']}",
         'Accept': 'application/vnd.github.v3+json'
     }
-    if details:
-        table = "| Step | Status | Details |\n|------|--------|---------|\n"
-        for step, detail in details.items():
-            table += f"| {step} | {detail['status']} | {detail['message']} |\n"
-        message += f"\n\n{table}"
-    data = {'body': message}
-    response = requests.post(comment_url, headers=headers, json=data)
-    if response.status_code != 201:
+    started_at = time.time()
+    try:
+        if status['url'] is None:
+            status['url'] = find_status_comment(comment_url, headers)
+        if status['url']:
+            response = github_request('PATCH', status['url'], headers=headers, json={'body': body})
+            expected_status = 200
+        else:
+            response = github_request('POST', comment_url, headers=headers, json={'body': body})
+            expected_status = 201
+    except requests.RequestException as e:
+        logger.error(f"Failed to comment on PR: {e}")
+        return
+    finally:
+        status['last_write'] = time.time()
+        STAGE_DURATION.labels('github_comment').observe(status['last_write'] - started_at)
+    if response.status_code != expected_status:
         logger.error(f"Failed to comment on PR: {response.json()}")
+        if response.status_code == 404:
+            # The status comment was deleted; post a new one on the next update
+            status['url'] = None
+        return
+    status['url'] = response.json()['url']
+    status['written_body'] = body
 
-def run_deployment_script(branch_name, pr_number, repo_url, comment_url, access_token):
-    log_file_path = f'/tmp/deployment_log_{branch_name}_{pr_number}.txt'
+def run_deployment_script(branch_name, pr_number, repo_url, comment_url, access_token, job=None, head_sha=None, port=None, workspace=None, docker_host=None, services=None):
+    log_file_path = get_log_path('deployment', pr_number, job and job['repo_name'], job and job['id'])
     details = {}
-    with open(log_file_path, 'w') as log_file:
+    with open(log_file_path, 'w', encoding='utf-8') as log_file:
         try:
-            result = subprocess.run(['./deploy.sh', branch_name, str(pr_number), repo_url], check=True, capture_output=True, text=True)
-            log_file.write(result.stdout)
-            logger.info(result.stdout)
+            if job and is_superseded(job):
+                raise DeploymentSuperseded(job['id'])
+            # Run in its own process group so a superseding event can kill the whole build
+            command = [DEPLOY_SCRIPT, branch_name, str(pr_number), repo_url]
+            if head_sha:
+                command.append(head_sha)
+            env = dict(os.environ)
+            if port:
+                env['DEPLOY_PORT'] = str(port)
+            if docker_host:
+                env['DOCKER_HOST'] = docker_host
+            deploy_host = get_docker_host_address(docker_host)
+            if deploy_host:
+                env['DEPLOY_HOST'] = deploy_host
+            if workspace:
+                env['DEPLOY_WORKSPACE'] = workspace
+            if services is not None:
+                env['DEPLOY_SERVICES'] = ' '.join(services)
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, encoding='utf-8', errors='replace', bufsize=1, env=env, start_new_session=True)
+            if job:
+                with pr_state_lock:
+                    running_deployments[get_pr_key(job)] = {'job_id': job['id'], 'process': process}
+
+            # Stream the output to the log file, keeping only the last lines in memory for error reporting
+            container_name = None
+            deployment_url = None
+            image_name = None
+            output_tail = deque(maxlen=DEPLOY_OUTPUT_TAIL_LINES)
+            stage = None
+            stage_started_at = time.time()
+            try:
+                for line in process.stdout:
+                    log_file.write(line)
+                    logger.info(line.rstrip())
+                    output_tail.append(line)
+
+                    # Time each deploy.sh stage from the line that starts it to the line that starts the next
+                    for marker, next_stage in STAGE_MARKERS:
+                        if marker in line:
+                            if stage:
+                                STAGE_DURATION.labels(stage).observe(time.time() - stage_started_at)
+                            stage = next_stage
+                            stage_started_at = time.time()
+                            break
 
-            # Extract container name and deployment URL from the output
-            container_name_match = re.search(r'Container name: ([^\s]+)', result.stdout)
-            deployment_url_match = re.search(r'Deployment complete: (http://[^\s]+)', result.stdout)
-            container_name = container_name_match.group(1) if container_name_match else None
-            deployment_url = deployment_url_match.group(1) if deployment_url_match else None
+                    # Extract container name and deployment URL from the output as they appear
+                    if container_name is None:
+                        container_name_match = re.search(r'Container name: ([^\s]+)', line)
+                        container_name = container_name_match.group(1) if container_name_match else None
+                    if deployment_url is None:
+                        deployment_url_match = re.search(r'Deployment complete: (http://[^\s]+)', line)
+                        deployment_url = deployment_url_match.group(1) if deployment_url_match else None
+                    if image_name is None:
+                        image_name_match = re.search(r'Image name: ([^\s]+)', line)
+                        image_name = image_name_match.group(1) if image_name_match else None
+                process.wait()
+                if stage:
+                    STAGE_DURATION.labels(stage).observe(time.time() - stage_started_at)
+            finally:
+                process.stdout.close()
+                # If reading the output failed, don't leave deploy.sh running without a reader
+                if process.returncode is None:
+                    try:
+                        os.killpg(process.pid, signal.SIGTERM)
+                    except ProcessLookupError:
+                        pass
+                    process.wait()
+                if job:
+                    with pr_state_lock:
+                        running_deployments.pop(get_pr_key(job), None)
+            if job and is_superseded(job):
+                log_file.write("Deployment cancelled: superseded by a newer event.\n")
+                raise DeploymentSuperseded(job['id'], container_name, deployment_url, image_name)
+            if process.returncode != 0:
+                raise subprocess.CalledProcessError(process.returncode, command, stderr=''.join(output_tail))
 
             details['Clone repository'] = {'status': 'Success', 'message': 'Repository cloned successfully.'}
             details['Checkout branch'] = {'status': 'Success', 'message': f'Checked out branch {branch_name}.'}
@@ -184,33 +1380,82 @@ def run_deployment_script(branch_name, pr_number, repo_url, comment_url, access_
             details['Run Docker container'] = {'status': 'Success', 'message': f'Container {container_name} running at {deployment_url}.'}
 
             notify_stakeholders(comment_url, "Deployment process details:", access_token, details)
-            return container_name, deployment_url, log_file_path
+            return container_name, deployment_url, log_file_path, image_name
 
         except subprocess.CalledProcessError as e:
-            log_file.write(f"Deployment script failed with error: {e.stderr}")
+            log_file.write(f"Deployment script failed with exit code {e.returncode}\n")
             logger.error(f"Deployment script failed with error: {e.stderr}")
-            details['Deployment script'] = {'status': 'Failed', 'message': e.stderr}
+            details['Deployment script'] = {'status': 'Failed', 'message': e.stderr.strip().replace('\n', '<br>')}
             notify_stakeholders(comment_url, "Deployment process details:", access_token, details)
-            return None, None, log_file_path
+            return None, None, log_file_path, None
 
-def run_cleanup_script(branch_name, pr_number, comment_url, access_token):
-    log_file_path = f'/tmp/cleanup_log_{branch_name}_{pr_number}.txt'
+def run_cleanup_script(branch_name, pr_number, comment_url, access_token, targets=None, workspace=None, job=None):
+    log_file_path = get_log_path('cleanup', pr_number, job and job['repo_name'], job and job['id'])
     details = {}
     with open(log_file_path, 'w') as log_file:
         try:
-            subprocess.run(['./cleanup.sh', branch_name, str(pr_number)], check=True, stdout=log_file, stderr=log_file)
+            # Clean up on each Docker engine the PR was deployed to
+            for docker_host, container_names in (targets or {None: []}).items():
+                step = f'Cleanup script ({docker_host})' if docker_host else 'Cleanup script'
+                env = dict(os.environ)
+                if workspace:
+                    env['DEPLOY_WORKSPACE'] = workspace
+                if docker_host:
+                    env['DOCKER_HOST'] = docker_host
+                log_file.flush()
+                subprocess.run([CLEANUP_SCRIPT, branch_name, str(pr_number), *container_names], check=True, stdout=log_file, stderr=log_file, env=env)
+                details[step] = {'status': 'Success', 'message': 'Cleanup script executed successfully.'}
             logger.info("Cleanup script executed successfully.")
-            details['Cleanup script'] = {'status': 'Success', 'message': 'Cleanup script executed successfully.'}
             notify_stakeholders(comment_url, "Cleanup process details:", access_token, details)
             return log_file_path
         except subprocess.CalledProcessError as e:
             log_file.write(f"Cleanup script failed with error: {e.stderr}")
             logger.error(f"Cleanup script failed with error: {e.stderr}")
-            details['Cleanup script'] = {'status': 'Failed', 'message': e.stderr}
+            details[step] = {'status': 'Failed', 'message': e.stderr}
             notify_stakeholders(comment_url, "Cleanup process details:", access_token, details)
             return log_file_path
 
-def send_email(to_address, subject, body, attachment_path, retries=3, retry_delay=5):
+def compress_log(log_path):
+    """Gzip a log file in chunks, keeping only its head and tail if it is larger than the attachment limit."""
+    size = os.path.getsize(log_path)
+    truncated = size > LOG_ATTACHMENT_MAX_BYTES
+    buffer = io.BytesIO()
+    with open(log_path, 'rb') as log_file, gzip.GzipFile(filename=os.path.basename(log_path), mode='wb', fileobj=buffer) as compressed:
+        if truncated:
+            keep = LOG_ATTACHMENT_MAX_BYTES // 2
+            remaining = keep
+            while remaining > 0:
+                chunk = log_file.read(min(64 * 1024, remaining))
+                if not chunk:
+                    break
+                compressed.write(chunk)
+                remaining -= len(chunk)
+            compressed.write(f"\n\n... {size - 2 * keep} bytes omitted ...\n\n".encode())
+            log_file.seek(size - keep)
+        shutil.copyfileobj(log_file, compressed, 64 * 1024)
+    return buffer.getvalue(), truncated
+
+def get_log_location(log_path):
+    """Return where the full log can be found, as a link when LOG_URL_BASE is configured."""
+    if LOG_URL_BASE:
+        return f"{LOG_URL_BASE}/{os.path.basename(log_path)}"
+    return f"{log_path} on the PR_TestBot host"
+
+def prepare_log(log_path, budget=EMAIL_ATTACHMENT_MAX_BYTES):
+    """Compress a log for attaching, returning the payload (None if it exceeds the budget) and a note for the email body."""
+    payload, truncated = compress_log(log_path)
+    if len(payload) > budget:
+        return None, f"The log is too large to attach. The full log is available at {get_log_location(log_path)}."
+    if truncated:
+        return payload, f"The attached log was shortened to its beginning and end. The full log is available at {get_log_location(log_path)}."
+    return payload, ''
+
+def build_email(to_address, subject, body, attachments):
+    """Build a MIME message with gzipped attachments given as (filename, payload) pairs."""
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.base import MIMEBase
+    from email import encoders
     from_address = SMTP_USERNAME
     msg = MIMEMultipart()
     msg['From'] = from_address
@@ -219,33 +1464,164 @@ def send_email(to_address, subject, body, attachment_path, retries=3, retry_dela
 
     msg.attach(MIMEText(body, 'plain'))
 
+    for filename, payload in attachments:
+        part = MIMEBase('application', 'gzip')
+        part.set_payload(payload)
+        encoders.encode_base64(part)
+        part.add_header('Content-Disposition', f'attachment; filename= {filename}')
+        msg.attach(part)
+    return msg
+
+def send_email(to_address, subject, body, attachment_path, retries=3, retry_delay=5):
+    """Build the email and hand it to the background email dispatcher."""
+    # Attach the log gzipped and capped, linking to the stored copy when it had to be cut or left out
     try:
-        with open(attachment_path, 'rb') as attachment:
-            part = MIMEBase('application', 'octet-stream')
-            part.set_payload(attachment.read())
-            encoders.encode_base64(part)
-            part.add_header('Content-Disposition', f'attachment; filename= {os.path.basename(attachment_path)}')
-            msg.attach(part)
+        payload, note = prepare_log(attachment_path)
     except Exception as e:
         logger.error(f"Failed to attach file: {e}")
         return False
+    if note:
+        body += f"\n\n{note}"
+    attachments = [(f'{os.path.basename(attachment_path)}.gz', payload)] if payload is not None else []
+
+    email_queue.put((to_address, build_email(to_address, subject, body, attachments), retries, retry_delay))
+    return True
+
+def report_result(subject, body, summary, log_file_path, failed=False):
+    """Email a deployment or cleanup log right away, or add it to the next digest."""
+    if EMAIL_DIGEST_INTERVAL <= 0 or (failed and EMAIL_DIGEST_FAILURES_IMMEDIATE):
+        return send_email(RECIPIENT_EMAIL, subject, body, log_file_path)
+
+    # Compress the log now so the digest only holds what it will attach.
+    # Attachments share one size budget per digest; logs beyond it are only linked.
+    with email_digest_lock:
+        budget = EMAIL_ATTACHMENT_MAX_BYTES - email_digest['attached_bytes']
+    try:
+        payload, note = prepare_log(log_file_path, budget)
+    except Exception as e:
+        logger.error(f"Failed to attach file: {e}")
+        payload, note = None, f"The log could not be attached. It is stored at {get_log_location(log_file_path)}."
+    entry = {
+        'time': datetime.now(timezone.utc),
+        'summary': summary,
+        'failed': failed,
+        'filename': os.path.basename(log_file_path),
+        'payload': payload,
+        'note': note
+    }
+    with email_digest_lock:
+        # Another result may have used up the budget while this log was being compressed
+        if payload is not None and email_digest['attached_bytes'] + len(payload) > EMAIL_ATTACHMENT_MAX_BYTES:
+            entry['payload'] = None
+            entry['note'] = f"The log is too large to attach. The full log is available at {get_log_location(log_file_path)}."
+        email_digest['entries'].append(entry)
+        if entry['payload'] is not None:
+            email_digest['attached_bytes'] += len(entry['payload'])
+    return True
+
+def flush_email_digest():
+    """Send the accumulated results as a single summary email."""
+    with email_digest_lock:
+        entries = email_digest['entries']
+        email_digest['entries'] = []
+        email_digest['attached_bytes'] = 0
+    if not entries:
+        return
+
+    failures = sum(1 for entry in entries if entry['failed'])
+    lines = [f"{len(entries)} result(s) since {entries[0]['time']:%Y-%m-%d %H:%M:%S} UTC, {failures} failed.", '']
+    attachments = []
+    for index, entry in enumerate(entries, 1):
+        lines.append(f"{index}. [{entry['time']:%H:%M:%S}] {entry['summary']}")
+        if entry['payload'] is not None:
+            filename = f"{index:03d}-{entry['filename']}.gz"
+            attachments.append((filename, entry['payload']))
+            lines.append(f"   Log attached as {filename}.")
+        if entry['note']:
+            lines.append(f"   {entry['note']}")
+    subject = f"PR_TestBot Digest: {len(entries)} result(s), {failures} failed"
+    email_queue.put((RECIPIENT_EMAIL, build_email(RECIPIENT_EMAIL, subject, '\n'.join(lines), attachments), 3, 5))
 
-    attempt = 0
-    while attempt < retries:
+def email_digest_sender():
+    """Send a digest email every EMAIL_DIGEST_INTERVAL seconds."""
+    while True:
+        time.sleep(EMAIL_DIGEST_INTERVAL)
         try:
-            with smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=10) as server:
-                server.starttls()
-                server.login(from_address, SMTP_PASSWORD)
-                server.sendmail(from_address, to_address, msg.as_string())
-                logger.info("Email sent successfully")
-                return True
-        except (smtplib.SMTPException, ConnectionError) as e:
-            attempt += 1
-            logger.error(f"Failed to send email, attempt {attempt} of {retries}: {e}")
-            time.sleep(retry_delay)
+            flush_email_digest()
+        except Exception as e:
+            logger.error(f"Failed to send email digest: {e}")
+
+def open_smtp_connection():
+    """Open and authenticate a connection to the SMTP server."""
+    import smtplib
+    server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT, timeout=10)
+    try:
+        if SMTP_STARTTLS:
+            server.starttls()
+        server.login(SMTP_USERNAME, SMTP_PASSWORD)
+    except Exception:
+        server.close()
+        raise
+    return server
+
+def close_smtp_connection(server):
+    """Close an SMTP connection, ignoring errors from a connection that already dropped."""
+    import smtplib
+    try:
+        server.quit()
+    except (smtplib.SMTPException, OSError):
+        server.close()
 
-    logger.error("All attempts to send email failed")
-    return False
+def email_dispatcher():
+    """Send queued emails over a reused SMTP connection, retrying with backoff."""
+    import smtplib
+    server = None
+    while True:
+        try:
+            to_address, msg, retries, retry_delay = email_queue.get(timeout=SMTP_IDLE_TIMEOUT)
+        except queue.Empty:
+            # Don't hold the connection open while there is nothing to send
+            if server:
+                close_smtp_connection(server)
+                server = None
+            continue
+
+        attempt = 0
+        while attempt < retries:
+            try:
+                if server is None:
+                    server = open_smtp_connection()
+                with STAGE_DURATION.labels('send_email').time():
+                    server.sendmail(SMTP_USERNAME, to_address, msg.as_string())
+                EMAILS_SENT.inc()
+                logger.info("Email sent successfully")
+                break
+            except (smtplib.SMTPException, OSError) as e:
+                SMTP_ERRORS.inc()
+                attempt += 1
+                logger.error(f"Failed to send email, attempt {attempt} of {retries}: {e}")
+                if server:
+                    close_smtp_connection(server)
+                    server = None
+                if attempt < retries:
+                    time.sleep(retry_delay * 2 ** (attempt - 1))
+            except Exception as e:
+                # Not a delivery problem, so retrying cannot help; drop this email and keep the dispatcher alive
+                SMTP_ERRORS.inc()
+                logger.exception(f"Failed to send email to {to_address}, dropping it: {e}")
+                if server:
+                    close_smtp_connection(server)
+                    server = None
+                break
+        else:
+            logger.error("All attempts to send email failed")
+        email_queue.task_done()
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000)
+    start_workers()
+    if SERVER_MODE == 'gevent':
+        from gevent.pywsgi import WSGIServer
+        logger.info("Serving with gevent on port 5000")
+        WSGIServer(('0.0.0.0', 5000), app).serve_forever()
+    else:
+        app.run(host='0.0.0.0', port=5000)